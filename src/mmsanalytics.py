@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Grade analytics over lots of assignments at once. Assignments are loaded
+# into an AssignmentTable, which keeps each field as a NumPy column, so that
+# module marks, class percentiles and year on year trends are worked out with
+# array operations rather than a loop over every assignment. Requires numpy.
+#
+#   table = AssignmentTable.from_rows(lib.iter_assignments(modules))
+#   marks = table.module_marks()
+from mmslib import MMSLib, FetchError
+import numpy
+import sys
+
+class AssignmentTable(object):
+    # Each argument is a sequence with an entry per assignment. Missing grades
+    # and weightings are None.
+    def __init__(self, academic_years, module_codes, ids, grades, weightings,
+            chart_links):
+        self.academic_years = numpy.array(academic_years, dtype=object)
+        self.module_codes = numpy.array(module_codes, dtype=object)
+        self.ids = numpy.array(ids, dtype=numpy.int64)
+        self.grades = _float_column(grades)
+        self.weightings = _float_column(weightings)
+        self.chart_links = list(chart_links)
+
+    # Builds a table from (module, tool, assignment), as yielded by
+    # MMSLib.iter_assignments.
+    @staticmethod
+    def from_rows(rows):
+        columns = ([], [], [], [], [], [])
+        for (module, tool, assignment) in rows:
+            columns[0].append(module.academic_year)
+            columns[1].append(module.module_code)
+            columns[2].append(assignment.id)
+            columns[3].append(assignment.grade)
+            columns[4].append(assignment.weighting)
+            columns[5].append(assignment.chart_link)
+        return AssignmentTable(*columns)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # The mark for each module, as the average of its graded assignments
+    # weighted by their weightings. Returns { (year, module code) : mark }.
+    def module_marks(self):
+        graded = ~numpy.isnan(self.grades) & ~numpy.isnan(self.weightings)
+        keys = zip(self.academic_years[graded], self.module_codes[graded])
+        means = _weighted_means(keys, self.grades[graded],
+                self.weightings[graded])
+        return dict((key, mark) for (key, (mark, count)) in means.iteritems())
+
+    # Average grade for each year, weighted by the assignments' weightings.
+    # Returns { year : (mark, number of graded assignments) }.
+    def year_trends(self):
+        graded = ~numpy.isnan(self.grades) & ~numpy.isnan(self.weightings)
+        return _weighted_means(self.academic_years[graded],
+                self.grades[graded], self.weightings[graded])
+
+    # Fetches the class grades for every assignment with a chart, on the
+    # library's worker threads. Returns { assignment id : [grade] }; charts
+    # which couldn't be fetched are left out.
+    def fetch_charts(self, lib):
+        with_charts = [i for (i, link) in enumerate(self.chart_links) \
+                if link != None]
+        charts = lib.fetch_charts([self.chart_links[i] for i in with_charts])
+        ret = {}
+        for (i, chart) in zip(with_charts, charts):
+            if not isinstance(chart, FetchError):
+                ret[int(self.ids[i])] = chart
+        return ret
+
+    # Where each grade sits in its class, as the percentage of the class who
+    # got the same or less. charts is as returned by fetch_charts. Returns
+    # { assignment id : percentile }.
+    def percentiles(self, charts):
+        rows = [i for i in range(len(self)) if not numpy.isnan(self.grades[i])
+                and len(charts.get(int(self.ids[i]), [])) > 0]
+        if len(rows) == 0:
+            return {}
+        # All of the class grades in one array, with the row each belongs to
+        class_grades = numpy.concatenate(
+                [numpy.asarray(charts[int(self.ids[i])], dtype=float) \
+                for i in rows])
+        groups = numpy.repeat(numpy.arange(len(rows)),
+                [len(charts[int(self.ids[i])]) for i in rows])
+        at_or_below = class_grades <= self.grades[rows][groups]
+        percentiles = 100.0 * numpy.bincount(groups, weights=at_or_below) / \
+                numpy.bincount(groups)
+        return dict((int(self.ids[i]), float(percentile)) \
+                for (i, percentile) in zip(rows, percentiles))
+
+def _float_column(values):
+    return numpy.array([numpy.nan if value == None else value \
+            for value in values], dtype=float)
+
+# sum(grade * weight) / sum(weight) for each distinct key. Returns
+# { key : (mean, count) }, leaving out keys whose weights add up to 0.
+def _weighted_means(keys, grades, weights):
+    if len(grades) == 0:
+        return {}
+    key_list = list(keys)
+    unique_keys = sorted(set(key_list))
+    key_index = dict((key, i) for (i, key) in enumerate(unique_keys))
+    groups = numpy.array([key_index[key] for key in key_list])
+    totals = numpy.bincount(groups, weights=grades * weights)
+    total_weights = numpy.bincount(groups, weights=weights)
+    counts = numpy.bincount(groups)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        means = totals / total_weights
+    return dict((key, (float(mean), int(count))) for (key, mean, count) in \
+            zip(unique_keys, means, counts) if not numpy.isnan(mean))
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 2:
+        print "Usage: mmsanalytics.py [--all-years] [--charts] <user> <password>"
+        sys.exit(-1)
+    lib = MMSLib(args[0], args[1], max_workers=4)
+    modules = None
+    if "--all-years" in sys.argv:
+        modules = [module for by_code in lib.get_all_years().itervalues() \
+                for by_semester in by_code.itervalues() \
+                for module in by_semester.itervalues()]
+    table = AssignmentTable.from_rows(lib.iter_assignments(modules))
+
+    print "Module marks:"
+    for ((year, code), mark) in sorted(table.module_marks().iteritems()):
+        print "  %s %-8s %6.2f" % (year, code, mark)
+    print "By year:"
+    for (year, (mark, count)) in sorted(table.year_trends().iteritems()):
+        print "  %s %6.2f (%d assignments)" % (year, mark, count)
+    if "--charts" in sys.argv:
+        percentiles = table.percentiles(table.fetch_charts(lib))
+        print "Class percentiles:"
+        for (id, percentile) in sorted(percentiles.iteritems()):
+            print "  %d %5.1f%%" % (id, percentile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Exports coursework from MMS to a CSV or JSON Lines file, one row per
+# assignment, for loading into spreadsheets and analysis tools.
+# Rows are written out as they're fetched, so memory use stays the same
+# however many years and modules there are.
+from mmslib import MMSLib, FetchError
+import csv
+import json
+import sys
+import time
+
+USAGE = "Usage: mmsexport.py [--all-years] [--feedback] <user> <password> " + \
+        "<output.csv|output.jsonl>"
+FIELDS = ["academic_year", "semester", "module_code", "module_name", "tool",
+        "id", "name", "due_date", "feedback_date", "submitted_date", "grade",
+        "weighting", "submission_url"]
+FEEDBACK_FIELDS = ["feedback"]
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+class CSVWriter(object):
+    def __init__(self, f, fields):
+        self.fields = fields
+        self.writer = csv.writer(f)
+        self.writer.writerow(fields)
+
+    def write(self, row):
+        self.writer.writerow([_csv_value(row[field]) for field in self.fields])
+
+class JSONLinesWriter(object):
+    def __init__(self, f, fields):
+        self.f = f
+
+    def write(self, row):
+        self.f.write(json.dumps(row) + "\n")
+
+def _csv_value(value):
+    if value == None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+def _format_date(date):
+    if date == None:
+        return None
+    return time.strftime(DATE_FORMAT, date)
+
+def assignment_row(module, tool, assignment):
+    return { "academic_year" : module.academic_year,
+             "semester" : module.semester,
+             "module_code" : module.module_code,
+             "module_name" : module.module_name,
+             "tool" : tool.name,
+             "id" : assignment.id,
+             "name" : assignment.name,
+             "due_date" : _format_date(assignment.due_date),
+             "feedback_date" : _format_date(assignment.feedback_date),
+             "submitted_date" : _format_date(assignment.submitted_date),
+             "grade" : assignment.grade,
+             "weighting" : assignment.weighting,
+             "submission_url" : assignment.submission_url }
+
+# Feedback comes out as one string, each entry on its own line. Entries which
+# couldn't be fetched are left out.
+def feedback_text(feedback):
+    entries = []
+    for entry in feedback:
+        if not isinstance(entry, FetchError):
+            entries.append(repr(entry))
+    return "\n".join(entries)
+
+# Modules for every year, oldest first, or None for this year's (which
+# iter_assignments fetches lazily).
+def export_modules(lib, all_years):
+    if not all_years:
+        return None
+    modules = []
+    for (year, by_code) in sorted(lib.get_all_years().iteritems()):
+        for (code, by_semester) in sorted(by_code.iteritems()):
+            for (semester, module) in sorted(by_semester.iteritems()):
+                modules.append(module)
+    return modules
+
+# Writes a row for each assignment, returning the number written.
+def export(lib, writer, all_years=False, with_feedback=False):
+    count = 0
+    for (module, tool, assignment) in \
+            lib.iter_assignments(export_modules(lib, all_years)):
+        row = assignment_row(module, tool, assignment)
+        if with_feedback:
+            row["feedback"] = feedback_text(
+                    lib.fetch_feedback(assignment._feedback_urls))
+        writer.write(row)
+        count += 1
+    return count
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 3:
+        print USAGE
+        sys.exit(-1)
+    (user, passwd, output) = args
+    all_years = "--all-years" in sys.argv
+    with_feedback = "--feedback" in sys.argv
+
+    fields = FIELDS
+    if with_feedback:
+        fields = FIELDS + FEEDBACK_FIELDS
+    if output.endswith(".csv"):
+        writer_class = CSVWriter
+    elif output.endswith(".jsonl"):
+        writer_class = JSONLinesWriter
+    else:
+        print USAGE
+        sys.exit(-1)
+
+    lib = MMSLib(user, passwd)
+    with open(output, "wb") as f:
+        count = export(lib, writer_class(f, fields), all_years, with_feedback)
+    print "Exported %d assignments to %s" % (count, output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# A stand-in for MMS and the St Andrews login server, for trying mmslib out
+# without the real thing (or real credentials). It makes up students, each
+# with a few years of modules, coursework tables, feedback (in MMS' own
+# not-quite-JSON), grade charts, submissions and content files. Responses can
+# be slowed down, fail with a 503, or lose their session, to see how clients
+# cope with MMS having a bad day. (The login server is left alone.)
+#
+# Run it on its own with
+#   mmsfake.py [port]
+# and point MMSLib at it by setting MMSLib.BASE_URL and MMSLib.LOGIN_URL to
+# the URL it prints. Students are student000, student001, ..., all with the
+# password "password". mmsload.py uses it for load testing.
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import Cookie
+import hashlib
+import random
+import re
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+PASSWORD = "password"
+SESSION_COOKIE = "MMSSESSION"
+LOGIN_ACTION = "cas/login"
+# Same as the real MMS and login server, which is what mmslib looks for
+NOT_LOGGED_IN_TEXT = "Log in here with your"
+INCORRECT_TEXT = "cannot be determined to be authentic"
+LAST_MODIFIED = "Wed, 02 Oct 2013 10:00:00 GMT"
+
+_MODULE_RE = re.compile("^/mms/module/([^/]+)/([^/]+)/([^/]+)/$")
+_TOOL_RE = re.compile("^/mms/module/([^/]+)/([^/]+)/([^/]+)/([^/]+)/$")
+
+# The made up students and everything they take. All of it is worked out from
+# the seed, the student and the year, so it's the same every time it's asked
+# for, without having to be stored.
+class FakeMMSData(object):
+    def __init__(self, students=10, years=("2011_2", "2012_3", "2013_4"),
+            modules_per_year=4, assignments_per_tool=5, files_per_tool=3,
+            file_size=64 * 1024, seed=0):
+        self.users = ["student%03d" % i for i in range(students)]
+        self.years = list(years)
+        self.modules_per_year = modules_per_year
+        self.assignments_per_tool = assignments_per_tool
+        self.files_per_tool = files_per_tool
+        self.file_size = file_size
+        self.seed = seed
+
+    def current_year(self):
+        return self.years[-1]
+
+    def _random(self, *parts):
+        key = ":".join(str(part) for part in (self.seed,) + parts)
+        return random.Random(int(hashlib.md5(key).hexdigest(), 16))
+
+    # Returns [(code, name, semester)] for the user's modules that year
+    def modules(self, user, year):
+        rng = self._random(user, year)
+        level = self.years.index(year) + 2
+        numbers = rng.sample(range(1, 100), self.modules_per_year)
+        return [("CS%d%03d" % (level, number),
+                 "Module %d%03d" % (level, number),
+                 rng.choice(["S1", "S2", "Y1"])) for number in numbers]
+
+    def module(self, user, year, code):
+        if year not in self.years:
+            return None
+        for module in self.modules(user, year):
+            if module[0] == code:
+                return module
+        return None
+
+    # Returns a dict for each assignment in a module's coursework tool
+    def assignments(self, user, year, code):
+        rng = self._random(user, year, code)
+        start_year = 2000 + int(year[2:4])
+        ret = []
+        for i in range(self.assignments_per_tool):
+            due = time.mktime((start_year, 10 + i % 3, 1 + 5 * i % 28, 23, 59,
+                0, 0, 0, -1))
+            graded = rng.random() < 0.7
+            ret.append({
+                "id" : int(code[2:]) * 100 + i,
+                "name" : "P%d - Practical %d" % (i + 1, i + 1),
+                "due" : due,
+                "feedback" : due + 14 * 24 * 60 * 60,
+                "submitted" : due - rng.randint(0, 72) * 60 * 60 \
+                        if rng.random() < 0.9 else None,
+                "grade" : rng.randint(7, 20) if graded else None,
+                "weighting" : rng.choice([10, 20, 25, 50]),
+                "feedback_ids" : range(rng.randint(0, 2)),
+                "chart" : graded,
+            })
+        return ret
+
+    def file_body(self, name, size=None):
+        if size == None:
+            size = self.file_size
+        pattern = hashlib.sha1(name).hexdigest()
+        return (pattern * (size / len(pattern) + 1))[:size]
+
+class FakeMMSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # latency: mean seconds to wait before answering each request
+    # error_rate: chance of a request failing with a 503
+    # expire_rate: chance of a request finding its session has expired
+    def __init__(self, address, data, latency=0, error_rate=0, expire_rate=0):
+        HTTPServer.__init__(self, address, FakeMMSHandler)
+        self.data = data
+        self.latency = latency
+        self.error_rate = error_rate
+        self.expire_rate = expire_rate
+        self.sessions = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def base_url(self):
+        return "http://%s:%d" % self.server_address
+
+class FakeMMSHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(False)
+
+    def do_HEAD(self):
+        self._handle(True)
+
+    # The login server. Unlike MMS, it doesn't have errors injected.
+    def do_POST(self):
+        self._start_request(False)
+        length = int(self.headers.get("content-length", 0))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        user = form.get("username", [None])[0]
+        if urlparse.urlsplit(self.path).path != "/" + LOGIN_ACTION:
+            return self._send(404, "Not found")
+        if user not in self.server.data.users or \
+                form.get("password") != [PASSWORD]:
+            return self._send(200, "<p>Your credentials %s.</p>" % \
+                    INCORRECT_TEXT)
+        token = hashlib.sha1("%s:%f:%f" % (user, time.time(),
+            random.random())).hexdigest()
+        with self.server.lock:
+            self.server.sessions[token] = user
+        self._send(302, "", { "Location" : "/mms/user/me/Modules",
+            "Set-Cookie" : "%s=%s; Path=/" % (SESSION_COOKIE, token) })
+
+    # Slows down and fails requests as configured. Returns whether to carry
+    # on with the request.
+    def _start_request(self, inject_errors=True):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency > 0:
+            time.sleep(random.uniform(0, 2 * server.latency))
+        if inject_errors and random.random() < server.error_rate:
+            self._send(503, "Service unavailable", { "Retry-After" : "0" })
+            return False
+        return True
+
+    def _user(self):
+        cookie = Cookie.SimpleCookie(self.headers.get("cookie", ""))
+        if SESSION_COOKIE not in cookie:
+            return None
+        token = cookie[SESSION_COOKIE].value
+        with self.server.lock:
+            if random.random() < self.server.expire_rate:
+                self.server.sessions.pop(token, None)
+            return self.server.sessions.get(token)
+
+    def _handle(self, head):
+        if not self._start_request():
+            return
+        user = self._user()
+        if user == None:
+            return self._send(200, _login_page(), head=head)
+
+        (path, query) = urllib.splitquery(self.path)
+        args = urlparse.parse_qs(query or "")
+        data = self.server.data
+        module = None
+        if path == "/mms/user/me/Modules":
+            year = args.get("academic_year", [""])[0].replace("/", "_")
+            if year == "":
+                year = data.current_year()
+            if year not in data.years:
+                return self._send(404, "Not found", head=head)
+            return self._send(200, _modules_page(data, user, year), head=head)
+
+        match = _MODULE_RE.match(path)
+        if match:
+            (year, semester, code) = match.groups()
+            module = data.module(user, year, code)
+            if module == None or module[2] != semester:
+                return self._send(404, "Not found", head=head)
+            return self._send(200, _module_page(year, module), head=head)
+
+        match = _TOOL_RE.match(path)
+        if match:
+            (year, semester, code, tool) = match.groups()
+            module = data.module(user, year, code)
+        if module == None or module[2] != semester:
+            return self._send(404, "Not found", head=head)
+
+        if tool == "Coursework":
+            assignments = data.assignments(user, year, code)
+            if "download" in args:
+                return self._send_file(data.file_body(self.path),
+                        args["file"][0], head)
+            elif "action" in args:
+                return self._send(200, _feedback_json(user,
+                    int(args["id"][0])), head=head)
+            elif "chart" in args:
+                return self._send(200, _chart_json(data, user, year, code,
+                    int(args["chart"][0])), head=head)
+            return self._send(200, _cwk_page(code, assignments), head=head)
+        elif tool == "Content":
+            if "download" in args:
+                name = "lecture%02d.pdf" % int(args["download"][0])
+                return self._send_file(data.file_body(path + name), name, head)
+            return self._send(200, _content_page(data), head=head)
+        return self._send(404, "Not found", head=head)
+
+    # Sends a file as MMS does, with the headers needed for conditional and
+    # resumed downloads
+    def _send_file(self, body, filename, head):
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        headers = { "Content-Disposition" :
+                        "attachment; filename=\"%s\"" % filename,
+                    "Content-Type" : "application/octet-stream",
+                    "Accept-Ranges" : "bytes", "ETag" : etag,
+                    "Last-Modified" : LAST_MODIFIED }
+        if self.headers.get("if-none-match") == etag or \
+                self.headers.get("if-modified-since") == LAST_MODIFIED:
+            return self._send(304, "", headers, head=True)
+        status = 200
+        range_header = self.headers.get("range")
+        if range_header != None and range_header.startswith("bytes="):
+            start = int(range_header[len("bytes="):].split("-")[0])
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start,
+                    len(body) - 1, len(body))
+            body = body[start:]
+            status = 206
+        self._send(status, body, headers, head=head)
+
+    def _send(self, status, body, headers={}, head=False):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        if "Content-Type" not in headers:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+        for (name, value) in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head and status != 304:
+            self.wfile.write(body)
+
+def _login_page():
+    return """<html><head><title>University of St Andrews Login</title></head>
+<body><div id="login"><p>%s University username and password.</p>
+<form id="fm1" action="%s" method="post">
+<input type="text" name="username" /><input type="password" name="password" />
+<input type="hidden" name="lt" value="LT-%d" />
+<input type="hidden" name="_eventId" value="submit" />
+<input type="submit" value="Login" /></form></div></body></html>""" % \
+        (NOT_LOGGED_IN_TEXT, LOGIN_ACTION, random.randint(0, 1000000))
+
+def _modules_page(data, user, year):
+    parts = ["""<html><head><title>MMS - My Modules</title></head><body>
+<div id="content"><form method="get" action="/mms/user/me/Modules">
+<select name="academic_year">"""]
+    for option in data.years:
+        parts.append('<option value="%s"%s>%s</option>' % (
+            option.replace("_", "/"),
+            ' selected="selected"' if option == year else "",
+            option.replace("_", "/")))
+    parts.append("</select></form>")
+    for (code, name, semester) in data.modules(user, year):
+        module_url = "/mms/module/%s/%s/%s/" % (year, semester, code)
+        parts.append('<h3 class="module_heading"><a href="%s">%s - %s</a></h3>'
+                % (module_url, code, name))
+        parts.append('<div class="module_content">\n'
+                '<ul class="module_resources">')
+        parts.append(_tool_links(module_url))
+        parts.append("</ul>\n</div>")
+    parts.append("</div></body></html>")
+    return "\n".join(parts)
+
+def _tool_links(module_url):
+    return ('<li><a class="resource coursework" href="%sCoursework/">'
+            'Coursework</a></li>\n'
+            '<li><a class="resource content" href="%sContent/">'
+            'Lecture Notes</a></li>\n'
+            '<li><a class="resource tas" href="%sAttendance/">'
+            'Attendance</a></li>') % (module_url, module_url, module_url)
+
+def _module_page(year, module):
+    (code, name, semester) = module
+    module_url = "/mms/module/%s/%s/%s/" % (year, semester, code)
+    return """<html><head><title>MMS - %s</title></head><body>
+<div id="content"><h2>%s - %s</h2><ul class="module_resources">
+%s
+</ul></div></body></html>""" % (code, code, name, _tool_links(module_url))
+
+def _cwk_page(code, assignments):
+    parts = ["""<html><head><title>MMS - %s Coursework</title></head><body>
+<div id="content"><h2>%s: Coursework</h2><form method="post" action="">
+<table class="coursework"><thead><tr><th>Name</th><th>Due</th>
+<th>Feedback</th><th>File</th><th>Submitted</th><th>Comments</th>
+<th>Grade</th><th>Weighting</th><th>Chart</th><th></th></tr></thead>
+<tbody>""" % (code, code)]
+    for assignment in assignments:
+        id = assignment["id"]
+        cells = [assignment["name"],
+                time.strftime("%d %b %y, %H:%M",
+                    time.localtime(assignment["due"])),
+                time.strftime("%d %b %y",
+                    time.localtime(assignment["feedback"]))]
+        if assignment["submitted"] != None:
+            cells.append('<a href="?download=%d&amp;file=p%d.zip">p%d.zip</a>'
+                    % (id, id, id))
+            cells.append(time.strftime("%d %b %y, %H:%M",
+                time.localtime(assignment["submitted"])))
+        else:
+            cells.extend(["&#160;", "&#160;"])
+        comments = ['<li><a href="?action=feedback&amp;id=%d">Comment from '
+                'Marker %d</a></li>' % (id * 10 + i, i) \
+                for i in assignment["feedback_ids"]]
+        comments.append('<li><a href="?action=comment&amp;id=%d">'
+                '[Add Comment]</a></li>' % id)
+        cells.append('<ul class="horizontal">%s</ul>' % "".join(comments))
+        if assignment["grade"] != None:
+            cells.append(str(assignment["grade"]))
+        else:
+            cells.append("&#160;")
+        cells.append("%d %%" % assignment["weighting"])
+        if assignment["chart"]:
+            cells.append('<a href="?chart=%d">Chart</a>' % id)
+        else:
+            cells.append("&#160;")
+        cells.append('<input type="hidden" name="id" value="%d" />' % id)
+        parts.append("<tr>\n%s\n</tr>" % "\n".join("<td>%s</td>" % cell \
+                for cell in cells))
+    parts.append("</tbody></table></form></div></body></html>")
+    return "\n".join(parts)
+
+# Feedback as MMS sends it: backslashes aren't escaped, quotes are.
+def _feedback_json(user, feedback_id):
+    return ('{"feedback_date": "%s", "sender_name": "Marker %d", '
+            '"comment": "Good work, %s. Your files in C:\\Users\\%s\\p%d '
+            'were \\"mostly\\" fine.\\nSee me about the rest."}') % (
+            time.strftime("%d/%m/%Y %H:%M", time.localtime(1381743000)),
+            feedback_id % 10, user, user, feedback_id / 10)
+
+def _chart_json(data, user, year, code, id):
+    rng = data._random(user, year, code, id)
+    return "[%s]" % ", ".join("[%d, %d]" % (grade, rng.randint(0, 12)) \
+            for grade in range(7, 21))
+
+def _content_page(data):
+    links = "\n".join('<li><a href="?download=%d">Lecture %d</a></li>' % \
+            (i, i) for i in range(data.files_per_tool))
+    return """<html><head><title>MMS - Lecture Notes</title></head><body>
+<div id="content"><h2>Lecture Notes</h2><ul>
+%s
+</ul></div></body></html>""" % links
+
+# Starts a server on a background thread, returning it. Use port 0 to pick
+# any free port, and server.base_url() to find out which.
+def start_server(data, port=0, **kwargs):
+    server = FakeMMSServer(("127.0.0.1", port), data, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    port = 8080
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    server = FakeMMSServer(("127.0.0.1", port), FakeMMSData())
+    print "Fake MMS running at %s" % server.base_url()
+    print "Log in as student000 to student009, password %s" % PASSWORD
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
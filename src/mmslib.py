@@ -3,14 +3,30 @@
 # I realised my old code was dated, unpythonic, and according to Lenary "horrible",
 # so it was probably best to start again.
 # Also, interesting to get my head out of functional-land every once in a while :)
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from multiprocessing.pool import Pool, ThreadPool
+import cgi
+import collections
+import cookielib
+import fcntl
+import email.utils
+import hashlib
 import htmllib
+import os
+import os.path
+import random
 import re
 import requests
+import struct
+import threading
 import time
 import json
 import sys
 import urllib
+import urlparse
+# time.strptime imports _strptime lazily, and that import isn't thread safe.
+# Do it up front, since feedback and coursework get parsed on worker threads.
+import _strptime
 # Exceptions:
 # ImproperUseError is thrown when the library isn't used properly.
 class ImproperUseError(Exception):
@@ -42,6 +58,16 @@ class CourseworkNotAvailableError(Exception):
     def __repr__(self):
         return "No coursework to download!"
 
+# FetchError stands in for the result of a single URL in a batch request which
+# failed, so that one bad URL doesn't take the rest of the batch down with it.
+class FetchError(Exception):
+    def __init__(self, url, error):
+        Exception.__init__(self)
+        self.url = url
+        self.error = error
+    def __repr__(self):
+        return "Error fetching %s: %r" % (self.url, self.error)
+
 # MMS Tools (at least the student ones. I'm not staff. If you're reading this,
 # Tristan, patches welcome ;))
 # TODO: Python 2 doesn't have enums... There must be a nicer way of doing this
@@ -87,36 +113,178 @@ class MMSToolType(object):
         else:
             return "Invalid Tool"
 
-class MMSTool(object):
+# The MMS objects below all have __slots__, to keep them small when there are
+# lots of them, and a fixed list of FIELDS. to_dict and from_dict convert them
+# to and from plain dicts of those fields, and pickling goes the same way, so
+# the MMSLib they hold on to is never saved along with them. Once loaded, give
+# them a library again with attach. See also dump_binary and load_binary.
+class MMSObject(object):
+    __slots__ = ()
+    FIELDS = ()
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, fields, lib=None):
+        obj = cls.__new__(cls)
+        obj.__setstate__(fields)
+        obj.attach(lib)
+        return obj
+
+    def attach(self, lib):
+        pass
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    # Objects pickled before these had slots come back with their old
+    # __dict__ as their state, so missing fields are left as None.
+    def __setstate__(self, state):
+        for field in self.FIELDS:
+            setattr(self, field, state.get(field))
+        self.attach(None)
+
+class MMSTool(MMSObject):
+    __slots__ = ("name", "tool_type", "url", "lib")
+    FIELDS = ("name", "tool_type", "url")
+
     def __init__(self, name, tool_type, url, lib):
         self.name = name
         self.tool_type = tool_type
         self.url = url
         self.lib = lib
 
+    def attach(self, lib):
+        self.lib = lib
+
 class MMSCourseworkTool(MMSTool):
+    __slots__ = ()
+
     def __init__(self, name, url, lib):
         MMSTool.__init__(self, name, MMSToolType.Coursework, url, lib)
 
     def get_assignments(self):
-        cwk_page = self.lib._mms_get(self.url)
-        assignments = _parse_cwk(cwk_page, self.url, self.lib)
-        return assignments
+        return self.lib._get_parsed(self.url, _parse_cwk, self.url, self.lib,
+                self.lib.fast_parse)
+
+    # As get_assignments, but yields each assignment as it's parsed (see
+    # MMSLib._iter_parsed)
+    def iter_assignments(self):
+        return self.lib._iter_parsed(self.url, _parse_cwk, _iter_cwk, self.url,
+                self.lib, self.lib.fast_parse)
+
+    # get_assignments in two halves, for when you want to look at the page
+    # before deciding whether it's worth parsing.
+    def get_page(self):
+        return self.lib._mms_get(self.url)
+
+    def parse_assignments(self, cwk_page):
+        return self.lib._parse(_parse_cwk, cwk_page, self.url, self.lib,
+                self.lib.fast_parse)
+
+    # Fetches the feedback for every given assignment (or every assignment in
+    # the tool) as one concurrent batch. Returns a list of feedback lists, in
+    # the same order as the assignments. Entries which couldn't be fetched are
+    # FetchErrors.
+    def get_all_feedback(self, assignments=None):
+        if assignments == None:
+            assignments = self.get_assignments()
+        urls = []
+        for assignment in assignments:
+            urls.extend(assignment._feedback_urls)
+        feedback = self.lib.fetch_feedback(urls)
+
+        ret = []
+        start = 0
+        for assignment in assignments:
+            end = start + len(assignment._feedback_urls)
+            ret.append(feedback[start:end])
+            start = end
+        return ret
+
+# A content tool's files are mirrored into a local directory, along with a
+# manifest recording what MMS said about each file when we downloaded it. The
+# next mirror asks MMS for each file only if it's changed since then, so an
+# unchanged file costs one empty response, and a changed one is streamed to
+# disk.
+class MMSContentTool(MMSTool):
+    __slots__ = ()
+    MANIFEST_NAME = ".mms-manifest.json"
+
+    def __init__(self, name, url, lib):
+        MMSTool.__init__(self, name, MMSToolType.Content, url, lib)
+
+    # Lists the MMSContentFiles in the tool.
+    def get_files(self):
+        return self.lib._parse(_parse_content, self.lib._mms_get(self.url),
+                self.url, self.lib.fast_parse)
+
+    # Brings dest_dir up to date with the tool, downloading up to max_workers
+    # files at a time. Returns a result for each file, in order: the local
+    # path if it was downloaded, None if it hadn't changed, or a FetchError.
+    def mirror(self, dest_dir):
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        manifest_path = os.path.join(dest_dir, self.MANIFEST_NAME)
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        urls = [content_file.url for content_file in self.get_files()]
+        results = self.lib._fetch_all(lambda url: self.lib._mms_mirror_file(url,
+            dest_dir, manifest.get(url)), urls)
+
+        ret = []
+        for (url, result) in zip(urls, results):
+            if isinstance(result, FetchError):
+                ret.append(result)
+                continue
+            (local_path, entry) = result
+            manifest[url] = entry
+            ret.append(local_path)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.rename(manifest_path + ".tmp", manifest_path)
+        return ret
+
+class MMSContentFile(MMSObject):
+    __slots__ = ("name", "url")
+    FIELDS = __slots__
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
 
 # Representation of an MMS Module
-class MMSModule(object):
-    def __init__(self, module_code, module_name, semester, tools):
+# academic_year is in the form MMS uses in URLs, such as 2013_4.
+class MMSModule(MMSObject):
+    __slots__ = ("module_code", "module_name", "semester", "tools",
+            "academic_year")
+    FIELDS = __slots__
+
+    def __init__(self, module_code, module_name, semester, tools,
+            academic_year=None):
         self.module_code = module_code
         self.module_name = module_name
         self.semester = semester
         self.tools = tools
+        self.academic_year = academic_year
 
     def get_tools(self, tool_ty=None):
         if tool_ty == None:
             return self.tools
         return filter(lambda tool: tool.tool_type == tool_ty, self.tools)
 
-class MMSFeedback(object):
+    def attach(self, lib):
+        for tool in self.tools or []:
+            tool.attach(lib)
+
+class MMSFeedback(MMSObject):
+    __slots__ = ("name", "date", "content", "file_url")
+    FIELDS = __slots__
+
     def __init__(self, name, date, content, file_url):
         self.name = name
         self.date = date
@@ -135,7 +303,14 @@ class MMSFeedback(object):
     def __str__(self):
         return self.__repr__().encode("utf-8", "ignore")
 
-class MMSAssignment(object):
+class MMSAssignment(MMSObject):
+    __slots__ = ("id", "name", "due_date", "feedback_date", "submitted_date",
+            "submission_url", "_feedback_urls", "grade", "weighting",
+            "chart_link", "_lib")
+    FIELDS = ("id", "name", "due_date", "feedback_date", "submitted_date",
+            "submission_url", "_feedback_urls", "grade", "weighting",
+            "chart_link")
+
     def __init__(self, id, name, due_date, feedback_date, submitted_date,
             submission_url, feedback_urls, grade, weighting, chart_link, lib):
         self.id = id
@@ -147,6 +322,10 @@ class MMSAssignment(object):
         self._feedback_urls = feedback_urls
         self.grade = grade
         self.weighting = weighting
+        self.chart_link = chart_link
+        self._lib = lib
+
+    def attach(self, lib):
         self._lib = lib
 
     def __repr__(self):
@@ -179,12 +358,505 @@ class MMSAssignment(object):
         return self.__repr__().encode("utf-8", "ignore")
 
     def get_feedback(self):
-        return map(lambda x: _fetch_feedback(x, self._lib), self._feedback_urls)
+        feedback = self._lib.fetch_feedback(self._feedback_urls)
+        for entry in feedback:
+            if isinstance(entry, FetchError):
+                raise entry.error
+        return feedback
 
-    def download_submission(self):
+    # The grades of everybody in the class, from the assignment's chart, or
+    # None if it doesn't have one.
+    def get_chart(self):
+        if self.chart_link == None:
+            return None
+        chart = self._lib.fetch_charts([self.chart_link])[0]
+        if isinstance(chart, FetchError):
+            raise chart.error
+        return chart
+
+    # Downloads the submission into dest_dir, returning the path to it.
+    def download_submission(self, dest_dir="."):
         if self.submission_url == None:
             raise CourseworkNotAvailableError
-        return self._lib._mms_download(self.submission_url)
+        return self._lib._mms_download(self.submission_url, dest_dir)
+
+# A compact binary form for MMS objects, and lists and dicts of them, for
+# when pickle is too big or too slow. Each value is a one byte tag followed by
+# its data, packed with struct; objects are written as their FIELDS in order.
+# The library references are left out, so pass load_binary the MMSLib to
+# attach the objects to.
+BINARY_MAGIC = "MMS\x01"
+# Only append to this, the index of each class is part of the format
+_BINARY_CLASSES = [MMSTool, MMSCourseworkTool, MMSModule, MMSFeedback,
+        MMSAssignment, MMSContentTool, MMSContentFile]
+
+def dump_binary(value):
+    out = [BINARY_MAGIC]
+    _dump_value(value, out)
+    return "".join(out)
+
+def load_binary(data, lib=None):
+    if not data.startswith(BINARY_MAGIC):
+        raise ImproperUseError("Not an MMS binary dump")
+    (value, offset) = _load_value(data, len(BINARY_MAGIC), lib)
+    return value
+
+def _dump_value(value, out):
+    if value == None:
+        out.append("N")
+    elif value is True or value is False:
+        out.append("T" if value else "F")
+    elif isinstance(value, (int, long)):
+        out.append(struct.pack(">cq", "i", value))
+    elif isinstance(value, float):
+        out.append(struct.pack(">cd", "d", value))
+    elif isinstance(value, unicode):
+        encoded = value.encode("utf-8")
+        out.append(struct.pack(">cI", "u", len(encoded)))
+        out.append(encoded)
+    elif isinstance(value, str):
+        out.append(struct.pack(">cI", "s", len(value)))
+        out.append(value)
+    elif isinstance(value, time.struct_time):
+        out.append(struct.pack(">c9i", "t", *value))
+    elif isinstance(value, (list, tuple)):
+        out.append(struct.pack(">cI", "l", len(value)))
+        for item in value:
+            _dump_value(item, out)
+    elif isinstance(value, dict):
+        out.append(struct.pack(">cI", "m", len(value)))
+        for (key, item) in value.iteritems():
+            _dump_value(key, out)
+            _dump_value(item, out)
+    elif type(value) in _BINARY_CLASSES:
+        out.append(struct.pack(">cB", "o", _BINARY_CLASSES.index(type(value))))
+        for field in value.FIELDS:
+            _dump_value(getattr(value, field), out)
+    else:
+        raise ImproperUseError("Can't dump %r" % type(value))
+
+# Returns the value starting at offset, and the offset just after it
+def _load_value(data, offset, lib):
+    tag = data[offset]
+    offset += 1
+    if tag == "N":
+        return (None, offset)
+    elif tag == "T" or tag == "F":
+        return (tag == "T", offset)
+    elif tag == "i":
+        return (struct.unpack_from(">q", data, offset)[0], offset + 8)
+    elif tag == "d":
+        return (struct.unpack_from(">d", data, offset)[0], offset + 8)
+    elif tag == "u" or tag == "s":
+        (length,) = struct.unpack_from(">I", data, offset)
+        offset += 4
+        value = data[offset:offset + length]
+        if tag == "u":
+            value = value.decode("utf-8")
+        return (value, offset + length)
+    elif tag == "t":
+        return (time.struct_time(struct.unpack_from(">9i", data, offset)),
+                offset + 36)
+    elif tag == "l":
+        (length,) = struct.unpack_from(">I", data, offset)
+        offset += 4
+        ret = []
+        for i in xrange(length):
+            (item, offset) = _load_value(data, offset, lib)
+            ret.append(item)
+        return (ret, offset)
+    elif tag == "m":
+        (length,) = struct.unpack_from(">I", data, offset)
+        offset += 4
+        ret = {}
+        for i in xrange(length):
+            (key, offset) = _load_value(data, offset, lib)
+            (ret[key], offset) = _load_value(data, offset, lib)
+        return (ret, offset)
+    elif tag == "o":
+        cls = _BINARY_CLASSES[ord(data[offset])]
+        offset += 1
+        fields = {}
+        for field in cls.FIELDS:
+            (fields[field], offset) = _load_value(data, offset, lib)
+        return (cls.from_dict(fields, lib), offset)
+    raise ImproperUseError("Corrupt MMS binary dump")
+
+# How MMSLib talks to MMS.
+# timeout: seconds to wait for a connection or data before giving up
+# retries: times to retry a GET that fails with a connection error, timeout,
+#     5xx or 429, waiting a random time up to backoff * 2^(retry - 1) seconds
+#     (at most max_backoff, or the server's Retry-After) before each retry
+# min_concurrency: the fewest requests in flight the limiter backs off to.
+#     The most is MMSLib's max_workers.
+# target_latency: responses slower than this many seconds count against the
+#     limiter, as errors do
+class MMSTransportPolicy(object):
+    def __init__(self, timeout=30, retries=3, backoff=0.5, max_backoff=30,
+            min_concurrency=1, target_latency=5):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+
+    def backoff_delay(self, attempt, resp=None):
+        if resp != None and resp.headers.get("retry-after", "").isdigit():
+            return min(self.max_backoff, int(resp.headers["retry-after"]))
+        return random.uniform(0,
+                min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+# Limits the number of requests in flight, adapting the limit to how MMS is
+# coping: each slow or failed request halves it (down to min_limit), and each
+# good one raises it a little, so it grows by about one per round of requests
+# (up to max_limit).
+class AdaptiveLimiter(object):
+    def __init__(self, min_limit, max_limit, target_latency):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self._cond:
+            self.in_flight -= 1
+            if not ok or latency > self.target_latency:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+# Instrumentation events, see MMSLib.add_hook.
+# url_class is one of "modules", "module", "coursework", "content",
+# "feedback", "chart", "download" or "other", see _url_class. status is None
+# if the request failed without a response. num_bytes is the size of the
+# response body, as it came over the wire.
+class MMSRequestEvent(object):
+    def __init__(self, url, url_class, status, num_bytes, latency, relogin):
+        self.url = url
+        self.url_class = url_class
+        self.status = status
+        self.num_bytes = num_bytes
+        self.latency = latency
+        self.relogin = relogin
+
+# Sent before a request is retried. error is the exception or status code it
+# failed with, and concurrency_limit the limiter's new limit.
+class MMSRetryEvent(object):
+    def __init__(self, url, url_class, attempt, error, delay,
+            concurrency_limit):
+        self.url = url
+        self.url_class = url_class
+        self.attempt = attempt
+        self.error = error
+        self.delay = delay
+        self.concurrency_limit = concurrency_limit
+
+class MMSParseEvent(object):
+    def __init__(self, parser, latency, num_bytes):
+        self.parser = parser
+        self.latency = latency
+        self.num_bytes = num_bytes
+
+# A hook which totals up the events it sees, per URL class and per parser.
+# Each total is a dict with count, bytes, time (seconds) and max_time; request
+# totals also count errors (no response, or a 4xx/5xx) and relogins. Retries
+# are counted per URL class, along with the lowest the concurrency limit went.
+class MMSStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.parses = {}
+        self.retries = {}
+        self.min_concurrency_limit = None
+
+    def __call__(self, event):
+        with self._lock:
+            if isinstance(event, MMSRetryEvent):
+                self.retries[event.url_class] = \
+                        self.retries.get(event.url_class, 0) + 1
+                if self.min_concurrency_limit == None or \
+                        event.concurrency_limit < self.min_concurrency_limit:
+                    self.min_concurrency_limit = event.concurrency_limit
+            elif isinstance(event, MMSRequestEvent):
+                totals = self._add(self.requests, event.url_class, event)
+                totals.setdefault("errors", 0)
+                totals.setdefault("relogins", 0)
+                if event.status == None or event.status >= 400:
+                    totals["errors"] += 1
+                if event.relogin:
+                    totals["relogins"] += 1
+            else:
+                self._add(self.parses, event.parser, event)
+
+    def _add(self, all_totals, key, event):
+        totals = all_totals.setdefault(key, { "count" : 0, "bytes" : 0,
+            "time" : 0.0, "max_time" : 0.0 })
+        totals["count"] += 1
+        totals["bytes"] += event.num_bytes
+        totals["time"] += event.latency
+        totals["max_time"] = max(totals["max_time"], event.latency)
+        return totals
+
+    def __repr__(self):
+        with self._lock:
+            ret = ["Requests:"]
+            for (url_class, totals) in sorted(self.requests.iteritems()):
+                ret.append("  %-12s %5d requests, %5d errors, %3d relogins, "
+                        "%9d bytes, %.3fs mean, %.3fs max" % (url_class,
+                        totals["count"], totals["errors"], totals["relogins"],
+                        totals["bytes"], totals["time"] / totals["count"],
+                        totals["max_time"]))
+            if len(self.retries) > 0:
+                ret.append("Retries: %s (concurrency limit fell to %d)" % \
+                        (", ".join("%s %d" % retries for retries in \
+                        sorted(self.retries.iteritems())),
+                        self.min_concurrency_limit))
+            ret.append("Parsing:")
+            for (parser, totals) in sorted(self.parses.iteritems()):
+                ret.append("  %-20s %5d pages, %9d bytes, %.3fs mean, "
+                        "%.3fs max" % (parser, totals["count"],
+                        totals["bytes"], totals["time"] / totals["count"],
+                        totals["max_time"]))
+            return "\n".join(ret)
+
+# On-disk cache of MMS responses, keyed by user and URL (MMS serves different
+# users different pages at the same URL). Alongside each body we keep the
+# ETag and Last-Modified headers it came with, so that we can make conditional
+# requests and reuse the body when MMS replies 304 Not Modified. The bodies are
+# capped at max_bytes in total; the least recently used entries go first.
+# When entries were last used is only saved along with the next change to the
+# cache (or by flush), rather than on every hit.
+# Several caches (in this process or others, for the same user or not) can
+# share a cache_dir, see _save_index.
+class MMSResponseCache(object):
+    INDEX_NAME = "index.json"
+    LOCK_NAME = "index.lock"
+
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024, user=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.user = user
+        self._lock = threading.Lock()
+        self._dirty = False
+        # Keys we've dropped since the index was last saved
+        self._deleted = set()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._index = self._load_index()
+
+    # Headers to make the request for url conditional, if we have it cached.
+    def conditional_headers(self, url):
+        headers = {}
+        with self._lock:
+            entry = self._index.get(self._key(url))
+        if entry != None:
+            if entry["etag"] != None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] != None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    # Returns (body, encoding, charset) for url, or None if it isn't cached
+    # (any more). charset is what the response declared, if anything.
+    def get(self, url):
+        key = self._key(url)
+        with self._lock:
+            entry = self._index.get(key)
+            if entry == None:
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    body = f.read()
+            except IOError:
+                del self._index[key]
+                self._deleted.add(key)
+                self._dirty = True
+                return None
+            entry["last_used"] = time.time()
+            self._dirty = True
+            return (body, entry["encoding"], entry.get("charset"))
+
+    def put(self, url, body, encoding, charset, etag, last_modified):
+        # Nothing to validate against next time, so no use keeping it.
+        if etag == None and last_modified == None:
+            return
+        if len(body) > self.max_bytes:
+            return
+        key = self._key(url)
+        with self._lock:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.rename(tmp_path, self._path(key))
+            self._index[key] = { "url" : url, "size" : len(body),
+                    "encoding" : encoding, "charset" : charset, "etag" : etag,
+                    "last_modified" : last_modified, "last_used" : time.time() }
+            self._deleted.discard(key)
+            self._save_index()
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self._index.itervalues())
+        by_age = sorted(self._index.iteritems(),
+                key=lambda (key, entry): entry["last_used"])
+        for (key, entry) in by_age:
+            if total <= self.max_bytes:
+                break
+            total -= entry["size"]
+            del self._index[key]
+            self._deleted.add(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    # Things which never change, like a past year's modules, are kept by name
+    # outside of the index, so they're never evicted.
+    def get_permanent(self, name):
+        try:
+            with open(self._permanent_path(name), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put_permanent(self, name, data):
+        path = self._permanent_path(name)
+        with self._lock:
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.rename(path + ".tmp", path)
+
+    def _permanent_path(self, name):
+        return os.path.join(self.cache_dir, "permanent-" + name)
+
+    # Saves any changes to the index which haven't been saved yet
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def _key(self, url):
+        if self.user == None:
+            return hashlib.sha256(url).hexdigest()
+        return hashlib.sha256(_user_key(self.user) + " " + url).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.INDEX_NAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    # Anybody else sharing the cache_dir has been saving the index too. So
+    # under a lock file, the index on disk is merged into ours first: entries
+    # they've added are kept, and ones we've dropped stay dropped. Eviction
+    # then goes by the merged index, so that the whole directory stays within
+    # max_bytes, and no body file is left without an entry.
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_NAME)
+        with open(os.path.join(self.cache_dir, self.LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                for (key, entry) in self._load_index().iteritems():
+                    if key in self._deleted:
+                        continue
+                    ours = self._index.get(key)
+                    if ours == None:
+                        self._index[key] = entry
+                    elif entry["last_used"] > ours["last_used"]:
+                        ours["last_used"] = entry["last_used"]
+                self._evict()
+                with open(index_path + ".tmp", "w") as f:
+                    json.dump(self._index, f)
+                os.rename(index_path + ".tmp", index_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._deleted = set()
+        self._dirty = False
+
+# Keeps parsed objects in memory, by the user and URL of the page they came
+# from, so that asking for the same thing again soon after costs nothing. Each
+# kind of page (see _url_class) is kept for its own time, in seconds. The most
+# pages' worth of bytes kept is max_bytes, least recently used going first.
+# One cache can be shared by several MMSLibs. MMS serves different pages to
+# different users at the same URL, so each user only sees their own entries.
+# The objects are shared between everybody who asks for them (and stay bound
+# to the MMSLib which fetched them), so don't change them.
+class MMSObjectCache(object):
+    DEFAULT_TTLS = { "modules" : 10 * 60, "module" : 10 * 60,
+            "coursework" : 60, "content" : 60, "feedback" : 10 * 60,
+            "chart" : 10 * 60, "download" : 60, "other" : 60 }
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttls=None):
+        self.max_bytes = max_bytes
+        self.ttls = dict(MMSObjectCache.DEFAULT_TTLS)
+        if ttls != None:
+            self.ttls.update(ttls)
+        # Counts of hits and misses, by kind of page
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+        # (user, URL) to (kind, expiry time, size, value), oldest use first
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+    # Returns (True, value) if url's objects are cached for user, or
+    # (False, None).
+    def get(self, user, url):
+        kind = _url_class(url)
+        key = (user, url)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry != None and entry[1] < time.time():
+                self._size -= entry[2]
+                entry = None
+            if entry == None:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return (False, None)
+            self._entries[key] = entry
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            return (True, entry[3])
+
+    # size is how big the page the value was parsed from was
+    def put(self, user, url, value, size):
+        kind = _url_class(url)
+        if size > self.max_bytes:
+            return
+        key = (user, url)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old != None:
+                self._size -= old[2]
+            self._entries[key] = (kind, time.time() + self.ttls[kind], size,
+                    value)
+            self._size += size
+            while self._size > self.max_bytes:
+                (_, (_, _, old_size, _)) = self._entries.popitem(last=False)
+                self._size -= old_size
+
+    # Drops everything cached for URLs starting with url_prefix (so a tool's
+    # URL takes its feedback with it) and/or of the given kind, for user or
+    # (if user is None) everybody. With none of them, drops everything.
+    def invalidate(self, url_prefix=None, kind=None, user=None):
+        with self._lock:
+            for ((entry_user, url), entry) in self._entries.items():
+                if (url_prefix == None or url.startswith(url_prefix)) and \
+                        (kind == None or entry[0] == kind) and \
+                        (user == None or entry_user == user):
+                    del self._entries[(entry_user, url)]
+                    self._size -= entry[2]
 
 # Accesses are stateful, so we need a class to encapsulate this
 class MMSLib(object):
@@ -193,13 +865,85 @@ class MMSLib(object):
     LOGIN_URL = "https://login.st-andrews.ac.uk"
     INCORRECT_TEXT = "cannot be determined to be authentic"
     NOT_LOGGED_IN_TEXT = "Log in here with your"
+    # Seconds to keep the current year's modules for in get_all_years. Past
+    # years don't change, so they're kept for good.
+    CURRENT_YEAR_TTL = 60 * 60
 
-    def __init__(self, user, passwd):
+    # max_workers bounds the number of requests issued at once by the batch
+    # methods (fetch_feedback and friends), and the number of requests in
+    # flight over the session overall. 1 keeps everything sequential.
+    # If cache_dir is given, pages are cached there (up to cache_size bytes)
+    # and only re-downloaded when MMS says they've changed.
+    # fast_parse switches the parsers over to lxml, only building the parts of
+    # each page that we actually read. Requires lxml to be installed.
+    # If cookie_file is given, the session cookies are kept there between
+    # runs, so that we only have to go through the SSO login when they expire.
+    # transport is an MMSTransportPolicy, setting timeouts, retries and how
+    # far the number of requests in flight may back off when MMS struggles.
+    # If raw_pages is set, pages go to the parsers as the bytes MMS sent (see
+    # MMSPage) rather than being squashed down to ASCII first. Names and
+    # comments then keep any accents they have.
+    # If parse_processes is set, the big pages (modules lists, coursework and
+    # module pages) are parsed on a pool of that many processes, while the
+    # fetching stays on threads. Parsing holds the GIL, so this lets it use
+    # more than one core. Call close when you're done, to stop the pool.
+    # object_cache is an MMSObjectCache, to keep the modules, assignments and
+    # feedback we've parsed in memory for a while. Without one, everything is
+    # fetched fresh every time.
+    def __init__(self, user, passwd, max_workers=1, cache_dir=None,
+            cache_size=64 * 1024 * 1024, fast_parse=False, cookie_file=None,
+            transport=None, raw_pages=False, parse_processes=0,
+            object_cache=None):
         # When creating object, try to login, and populate
         # cookies.
         self.user = user
         self.passwd = passwd
+        self.max_workers = max_workers
+        if fast_parse:
+            try:
+                import lxml
+            except ImportError:
+                raise ImproperUseError("fast_parse requires lxml")
+        self.fast_parse = fast_parse
+        self.raw_pages = raw_pages
+        self.object_cache = object_cache
+        self.cache = None
+        if cache_dir != None:
+            self.cache = MMSResponseCache(cache_dir, cache_size, user)
+        if transport == None:
+            transport = MMSTransportPolicy()
+        self.transport = transport
+        self._limiter = AdaptiveLimiter(transport.min_concurrency,
+                max(max_workers, transport.min_concurrency),
+                transport.target_latency)
+        # Only one thread logs in at a time. The generation counts completed
+        # logins, so that threads which were waiting can tell that somebody
+        # else has already done it for them.
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+        self._hooks = []
+        # See get_all_years
+        self._years_lock = threading.Lock()
+        self._current_year = None
+        self._past_years = {}
+        # (academic year, module code) to the module's page, see get_module
+        self._module_urls = {}
+        # Worker threads for map_concurrent and the batch methods, by pool
+        # level (see _pool_map). Started when they're first needed, and kept
+        # until close.
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._pool_local = threading.local()
+        # Started before the session, so that nothing but us gets forked
+        self._parse_pool = None
+        if parse_processes > 0:
+            self._parse_pool = Pool(parse_processes)
         self.sess = requests.Session()
+        self.cookie_file = cookie_file
+        if cookie_file != None:
+            self._load_cookies()
+        # If the saved session is still good this is all we need; if not,
+        # MMS sends us to the login page, and _mms_get logs in again.
         user_home = MMSLib.BASE_URL + "/mms/user/me/Modules"
         self._mms_get(user_home)
 
@@ -208,125 +952,947 @@ class MMSLib(object):
     def _login(self, login_page):
         # print "logging in"
         # Get the required hidden metadata for the SSO system
-        parsed_login = _parse_login(login_page)
+        parsed_login = self._parse(_parse_login, login_page, self.fast_parse)
         args = { "username" : self.user, "password": self.passwd,
                  "lt" : parsed_login["lt"], "_eventId" : parsed_login["eventid"] }
 
         # Make the login request
         req_url = MMSLib.LOGIN_URL + "/" + parsed_login["dest"]
-        resp = self.sess.post(req_url, data=args)
+        resp = self._send("POST", req_url, data=args)
 
         # If login failure, then throw an error
         if MMSLib.INCORRECT_TEXT in resp.text:
             raise AuthenticationError()
+        if self.cookie_file != None:
+            self._save_cookies()
         return resp.text
 
-    # Stateful get access, handles login if necessary
+    # The cookie file holds a live session, so refuse to use one that anybody
+    # else could have read or planted.
+    def _load_cookies(self):
+        if not os.path.exists(self.cookie_file):
+            return
+        st = os.stat(self.cookie_file)
+        if st.st_uid != os.getuid() or st.st_mode & 077:
+            raise ImproperUseError("Cookie file %s must be owned by you, and "
+                    "not accessible to anybody else" % self.cookie_file)
+        jar = cookielib.LWPCookieJar()
+        try:
+            jar.load(self.cookie_file, ignore_discard=True)
+        except (cookielib.LoadError, IOError):
+            return # Not to worry, we'll just log in again
+        self.sess.cookies.update(jar)
+
+    def _save_cookies(self):
+        jar = cookielib.LWPCookieJar()
+        for cookie in self.sess.cookies:
+            jar.set_cookie(cookie)
+        # Create the file with the right permissions before anything is in it
+        tmp_file = self.cookie_file + ".tmp"
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        os.close(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600))
+        jar.save(tmp_file, ignore_discard=True)
+        os.rename(tmp_file, self.cookie_file)
+
+    # Logs in again after a request (made during login_generation) came back
+    # with the login page. If several threads notice at once, only the first
+    # logs in; the rest wait for it, and then carry on with the new session.
+    def _relogin(self, login_generation, login_page):
+        with self._login_lock:
+            if self._login_generation == login_generation:
+                self._login(login_page)
+                self._login_generation += 1
+
+    # Instrumentation. Each hook is called with an MMSRequestEvent for every
+    # _mms_get and _mms_download, and an MMSParseEvent for every page parsed.
+    # Hooks may be called from several threads at once. MMSStats is a ready
+    # made hook which keeps a summary.
+    def add_hook(self, hook):
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        self._hooks = [h for h in self._hooks if h != hook]
+
+    def _emit(self, event):
+        for hook in self._hooks:
+            hook(event)
+
+    def close(self):
+        with self._pools_lock:
+            for pool in self._pools.itervalues():
+                pool.terminate()
+                pool.join()
+            self._pools = {}
+        if self.cache != None:
+            self.cache.flush()
+        if self._parse_pool != None:
+            self._parse_pool.terminate()
+            self._parse_pool.join()
+            self._parse_pool = None
+        self.sess.close()
+
+    # Calls parse_fn(*args), timing it if anybody's listening.
+    def _parse(self, parse_fn, *args):
+        if not self._hooks:
+            return self._run_parser(parse_fn, args)
+        start = time.time()
+        ret = self._run_parser(parse_fn, args)
+        self._emit(MMSParseEvent(parse_fn.__name__, time.time() - start,
+            len(args[0])))
+        return ret
+
+    # Fetches url and parses it with parse_fn(page, *args), unless the
+    # object cache already has the result. Only what was parsed from a
+    # successful response goes into the cache.
+    def _get_parsed(self, url, parse_fn, *args):
+        if self.object_cache != None:
+            (found, value) = self.object_cache.get(self.user, url)
+            if found:
+                return value
+        (page, status) = self._mms_get_with_status(url)
+        value = self._parse(parse_fn, page, *args)
+        if self.object_cache != None and status in _CACHEABLE_STATUSES:
+            self.object_cache.put(self.user, url, value, len(page))
+        return value
+
+    # The generator version of _get_parsed, for iter_fn, the generator version
+    # of parse_fn. Objects come from the object cache if they're there, and
+    # go into it once the page has been parsed all the way through (under the
+    # same key as parse_fn's, so the two share entries). The time spent
+    # parsing is sent to the hooks as an MMSParseEvent for parse_fn once the
+    # page is done. The parse pool is skipped: a process can't hand back any
+    # objects until it's finished the whole page.
+    def _iter_parsed(self, url, parse_fn, iter_fn, *args):
+        if self.object_cache != None:
+            (found, value) = self.object_cache.get(self.user, url)
+            if found:
+                for item in value:
+                    yield item
+                return
+        (page, status) = self._mms_get_with_status(url)
+        items = []
+        parse_time = 0.0
+        parsed = iter_fn(page, *args)
+        while True:
+            start = time.time()
+            try:
+                item = next(parsed)
+            except StopIteration:
+                break
+            finally:
+                parse_time += time.time() - start
+            if self.object_cache != None:
+                items.append(item)
+            yield item
+        if self._hooks:
+            self._emit(MMSParseEvent(parse_fn.__name__, parse_time, len(page)))
+        if self.object_cache != None and status in _CACHEABLE_STATUSES:
+            self.object_cache.put(self.user, url, items, len(page))
+
+    # Forgets our cached objects, see MMSObjectCache.invalidate
+    def invalidate(self, url_prefix=None, kind=None):
+        if self.object_cache != None:
+            self.object_cache.invalidate(url_prefix, kind, self.user)
+
+    # Runs parse_fn on the parse pool, if we've got one and it's worth it. The
+    # library can't go to the other process, so it's replaced with None there,
+    # and the objects which come back are attached to it here.
+    def _run_parser(self, parse_fn, args):
+        if self._parse_pool == None or parse_fn not in _PROCESS_PARSERS:
+            return parse_fn(*args)
+        args = tuple(None if arg is self else arg for arg in args)
+        ret = self._parse_pool.apply_async(parse_fn, args).get(_POOL_TIMEOUT)
+        _attach_all(ret, self)
+        return ret
+
+    # Stateful get access, handles login if necessary. Safe to call from
+    # several threads at once.
     def _mms_get(self, req_url):
-        resp = self.sess.get(req_url)
-        if MMSLib.NOT_LOGGED_IN_TEXT in resp.text:
-            return self._login(resp.text)
-        ## RAWR!!!! >=[
-        # Unicode is being incredibly annoying, and I can't fix it. So ASCII
-        # for now. Sorry, languages students.
-        html = resp.text.encode("ascii", "ignore")
-        html = html.replace("&#160;", "")
-        # html = unescape(html)
-        return html
-
-    # Stolen from...
+        return self._mms_get_with_status(req_url)[0]
+
+    # As _mms_get, but returns the status of the response along with the page
+    def _mms_get_with_status(self, req_url):
+        if not self._hooks:
+            return self._mms_get_page(req_url)[:2]
+        start = time.time()
+        status = None
+        relogin = False
+        num_bytes = 0
+        try:
+            (html, status, relogin, num_bytes) = self._mms_get_page(req_url)
+            return (html, status)
+        except requests.HTTPError as e:
+            status = e.response.status_code
+            num_bytes = len(e.response.content)
+            raise
+        finally:
+            self._emit(MMSRequestEvent(req_url, _url_class(req_url), status,
+                num_bytes, time.time() - start, relogin))
+
+    # Does the work for _mms_get. Returns the page, the status of the
+    # response, whether we had to log in again to get it, and the number of
+    # bytes received (for the login page too, if we got that first).
+    def _mms_get_page(self, req_url):
+        login_generation = self._login_generation
+        (text, status, num_bytes) = self._cached_get(req_url)
+        relogin = MMSLib.NOT_LOGGED_IN_TEXT in text
+        if relogin:
+            self._relogin(login_generation, text)
+            # Now we're logged in, replay the request we actually wanted
+            (text, status, page_bytes) = self._cached_get(req_url)
+            num_bytes += page_bytes
+            if MMSLib.NOT_LOGGED_IN_TEXT in text:
+                raise AuthenticationError()
+        if self.raw_pages:
+            return (text, status, relogin, num_bytes)
+        return (_clean_html(text), status, relogin, num_bytes)
+
+    # The current limit on requests in flight, see AdaptiveLimiter
+    @property
+    def concurrency_limit(self):
+        return self._limiter.limit
+
+    # Makes a request over the session, following the transport policy: at
+    # most the limiter's worth of requests at once, each with a timeout, and
+    # GETs and HEADs retried with backoff on connection errors, timeouts, 5xx
+    # and 429 responses.
+    def _send(self, method, url, **kwargs):
+        policy = self.transport
+        retries = policy.retries if method in ("GET", "HEAD") else 0
+        attempt = 0
+        while True:
+            resp = None
+            error = None
+            self._limiter.acquire()
+            start = time.time()
+            try:
+                resp = self.sess.request(method, url, timeout=policy.timeout,
+                        **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                failed = resp == None or resp.status_code >= 500 or \
+                        resp.status_code == 429
+                self._limiter.release(time.time() - start, not failed)
+
+            if not failed or attempt >= retries:
+                if error != None:
+                    raise error
+                return resp
+            attempt += 1
+            delay = policy.backoff_delay(attempt, resp)
+            if self._hooks:
+                self._emit(MMSRetryEvent(url, _url_class(url), attempt,
+                    error if error != None else resp.status_code, delay,
+                    self._limiter.limit))
+            time.sleep(delay)
+
+    # Gets the text and status of a page, and the size of the response body,
+    # going through the response cache if we have one. A 304 Not Modified is
+    # answered with the cached copy.
+    # With raw_pages, the text is an MMSPage rather than decoded unicode.
+    # If MMS is still answering with an error once _send's retries have run
+    # out, raises an HTTPError, rather than handing the error page on to the
+    # parsers (which would make it look like there was nothing there).
+    def _cached_get(self, req_url):
+        headers = {}
+        if self.cache != None:
+            headers = self.cache.conditional_headers(req_url)
+        resp = self._send("GET", req_url, headers=headers)
+
+        if resp.status_code == 304:
+            cached = self.cache.get(req_url)
+            if cached != None:
+                (body, encoding, charset) = cached
+                if self.raw_pages:
+                    return (MMSPage(body, charset), resp.status_code,
+                            len(resp.content))
+                return (body.decode(encoding, "replace"), resp.status_code,
+                        len(resp.content))
+            # Evicted since we asked. Ask again, unconditionally this time.
+            resp = self._send("GET", req_url)
+        resp.raise_for_status()
+
+        charset = _declared_encoding(resp.headers)
+        if self.raw_pages:
+            text = MMSPage(resp.content, charset)
+        else:
+            text = resp.text
+        if self.cache != None and resp.status_code == 200 and \
+                MMSLib.NOT_LOGGED_IN_TEXT not in text:
+            encoding = resp.encoding or resp.apparent_encoding
+            self.cache.put(req_url, resp.content, encoding, charset,
+                    resp.headers.get("etag"), resp.headers.get("last-modified"))
+        return (text, resp.status_code, len(resp.content))
+
+    # Downloads url into dest_dir, and returns the path of the local file.
+    # If the file's already there with the same size and modification time as
+    # MMS reports, it isn't downloaded again. The download goes to a .part
+    # file first, and if we're interrupted it's resumed from where it left
+    # off next time (if the server supports ranges). The .part file's ETag or
+    # Last-Modified is kept beside it, and sent as If-Range, so that a file
+    # which has been resubmitted in the meantime is fetched from scratch
+    # rather than spliced onto the old one.
+    # Originally stolen from...
     # http://stackoverflow.com/questions/16694907/
     #   how-to-download-large-file-in-python-with-requests-py
-    def _mms_download(self, url):
-        # Default to the filename...
-        local_filename = url.split('/')[-1]
-        r = self.sess.get(url, stream=True)
-        # But if we can, get the nice name instead :)
-        #print r.headers
-        if "content-disposition" in r.headers:
-            content_disp = r.headers.get("content-disposition")
-            local_filename = content_disp.split("filename=")[1].replace("\"","")
-
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024): 
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
+    def _mms_download(self, url, dest_dir="."):
+        return self._timed_download(url, self._download_file, url, dest_dir)
+
+    # Does the work for _mms_download. Returns the local path, the status of
+    # the last response and the number of bytes downloaded.
+    def _download_file(self, url, dest_dir):
+        head = self._send("HEAD", url, allow_redirects=True)
+        if head.status_code >= 400: # No HEAD support, so no skipping either
+            head = None
+            local_path = None
+        else:
+            local_path = os.path.join(dest_dir,
+                    _download_filename(url, head.headers))
+            if _is_downloaded(local_path, head.headers):
+                return (local_path, head.status_code, 0)
+
+        headers = {}
+        if local_path != None and os.path.exists(local_path + ".part") and \
+                head.headers.get("accept-ranges") == "bytes":
+            validator = _read_validator(local_path + ".part")
+            if validator != None and validator == _validator(head.headers):
+                offset = os.path.getsize(local_path + ".part")
+                headers["Range"] = "bytes=%d-" % offset
+                headers["If-Range"] = validator
+                # Finished, but didn't get as far as renaming it
+                if str(offset) == head.headers.get("content-length"):
+                    _finish_part(local_path)
+                    return (local_path, head.status_code, 0)
+
+        r = self._send("GET", url, headers=headers, stream=True)
+        r.raise_for_status()
+        if local_path == None:
+            local_path = os.path.join(dest_dir,
+                    _download_filename(url, r.headers))
+        # If we didn't get a partial response, start from scratch
+        mode = "ab"
+        if r.status_code != 206:
+            mode = "wb"
+            _write_validator(local_path + ".part", _validator(r.headers))
+        num_bytes = _save_download(r, local_path, mode)
+        return (local_path, r.status_code, num_bytes)
+
+    # Downloads url into dest_dir for MMSContentTool.mirror, unless it's the
+    # same as described by entry, the file's manifest entry from last time.
+    # Returns the local path (or None if it was unchanged) and the new entry.
+    # A local file which isn't the size it was downloaded at has been cut
+    # short or edited, so it's downloaded again whatever MMS says.
+    def _mms_mirror_file(self, url, dest_dir, entry):
+        return self._timed_download(url, self._mirror_file, url, dest_dir,
+                entry)
+
+    # Does the work for _mms_mirror_file, returning its result along with the
+    # status of the response and the number of bytes downloaded.
+    def _mirror_file(self, url, dest_dir, entry):
+        headers = {}
+        if entry != None and _is_mirrored(dest_dir, entry):
+            if entry["etag"] != None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] != None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        r = self._send("GET", url, headers=headers, stream=True)
+        if r.status_code == 304:
+            r.close()
+            return ((None, entry), r.status_code, 0)
+        r.raise_for_status()
+        filename = _download_filename(url, r.headers)
+        local_path = os.path.join(dest_dir, filename)
+        num_bytes = _save_download(r, local_path)
+        return ((local_path, { "path" : filename, "size" : num_bytes,
+                "etag" : r.headers.get("etag"),
+                "last_modified" : r.headers.get("last-modified") }),
+                r.status_code, num_bytes)
+
+    # Calls download_fn(*args), which returns (result, status, bytes
+    # downloaded), and returns the result. Sends an MMSRequestEvent for the
+    # download whether it succeeded, failed or was skipped, as _mms_get does
+    # for pages.
+    def _timed_download(self, url, download_fn, *args):
+        if not self._hooks:
+            return download_fn(*args)[0]
+        start = time.time()
+        status = None
+        num_bytes = 0
+        try:
+            (ret, status, num_bytes) = download_fn(*args)
+            return ret
+        except requests.HTTPError as e:
+            status = e.response.status_code
+            raise
+        finally:
+            self._emit(MMSRequestEvent(url, "download", status, num_bytes,
+                time.time() - start, False))
+
+    # Downloads the submissions for all of the given assignments, up to
+    # max_workers at a time (see _mms_download). Different assignments' files
+    # are often uploaded under the same name, so each goes in a directory of
+    # its own under dest_dir, named after its module and assignment (such as
+    # CS4102-2013_4-1234). Returns the local paths in the same order as the
+    # assignments: None for assignments with nothing submitted, and a
+    # FetchError for any which failed.
+    def download_submissions(self, assignments, dest_dir):
+        dirs = {}
+        for assignment in assignments:
+            if assignment.submission_url != None:
+                dirs[assignment.submission_url] = os.path.join(dest_dir,
+                        _submission_dir(assignment))
+        for path in dirs.itervalues():
+            if not os.path.exists(path):
+                os.makedirs(path)
+        urls = dirs.keys()
+        paths = dict(zip(urls, self._fetch_all(
+            lambda url: self._mms_download(url, dirs[url]), urls)))
+        return [paths.get(assignment.submission_url) \
+                for assignment in assignments]
 
     # Gets a list of MMSModules.
     # If academic_year is None, the current year is fetched.
     def get_modules(self, academic_year=None):
-        # https://mms.st-andrews.ac.uk/mms/user/me/Modules?academic_year=2011%2F2
-        req_url = MMSLib.BASE_URL + "/mms/user/me/Modules?academic_year=" 
-        if academic_year != None:
-            academic_year = academic_year.replace("_", "%2F")
-            req_url = req_url + academic_year
-
-        req_url = req_url + "&unit=&command=Get+My+Modules"
-        res = self._mms_get(req_url)
-        modules = _parse_modules_list(res, self)
+        req_url = _modules_url(academic_year)
+        modules = self._get_parsed(req_url, _parse_modules_list, self,
+                self.fast_parse)
+        self._index_modules(modules, academic_year)
         return modules
 
+    # Remembers where each module's page is, for get_module. Modules fetched
+    # for the current year are also filed under None.
+    def _index_modules(self, modules, academic_year):
+        for module in modules:
+            url = _module_url(module.academic_year, module.semester,
+                    module.module_code)
+            self._module_urls[(module.academic_year, module.module_code)] = url
+            if academic_year == None:
+                self._module_urls[(None, module.module_code)] = url
+
+    # Gets the modules for every academic year MMS has for us, as an index of
+    # year (2013_4) to module code to semester to MMSModule.
+    # Years before the current one are fetched once, and then kept for good
+    # (in the cache_dir, if there is one). The current year, along with the
+    # list of years, is fetched again once it's current_ttl seconds old.
+    def get_all_years(self, current_ttl=None):
+        if current_ttl == None:
+            current_ttl = MMSLib.CURRENT_YEAR_TTL
+        with self._years_lock:
+            if self._current_year == None or \
+                    time.time() - self._current_year[0] > current_ttl:
+                self._current_year = self._fetch_current_year()
+            (fetched, years, current, current_modules) = self._current_year
+
+            missing = []
+            for year in years:
+                if year >= current or year in self._past_years:
+                    continue
+                modules = self._load_past_year(year)
+                if modules == None:
+                    missing.append(year)
+                else:
+                    self._past_years[year] = modules
+            # A year which can't be fetched raises (see _cached_get), so
+            # only years MMS actually gave us are kept. One which comes back
+            # with no modules at all is more likely a page we couldn't make
+            # sense of than a real year, so that's not kept for good either.
+            for (year, modules) in \
+                    zip(missing, self.map_concurrent(self.get_modules, missing)):
+                if len(modules) > 0:
+                    self._past_years[year] = modules
+                    self._save_past_year(year, modules)
+
+            index = {}
+            all_modules = list(current_modules)
+            for year in years:
+                all_modules.extend(self._past_years.get(year, []))
+            for module in all_modules:
+                by_code = index.setdefault(module.academic_year, {})
+                by_code.setdefault(module.module_code, {})[module.semester] = \
+                        module
+            return index
+
+    # The list of years comes with the current year's modules page. Any years
+    # after the current one are fetched along with it, since they can change.
+    # Returns (time fetched, years, current year, modules).
+    def _fetch_current_year(self):
+        page = self._mms_get(_modules_url())
+        (years, current) = self._parse(_parse_academic_years, page,
+                self.fast_parse)
+        modules = self._parse(_parse_modules_list, page, self, self.fast_parse)
+        self._index_modules(modules, None)
+        later = [year for year in years if year > current]
+        for later_modules in self.map_concurrent(self.get_modules, later):
+            modules.extend(later_modules)
+        return (time.time(), years, current, modules)
+
+    # Past years are kept under the user's name as well as the year, since
+    # several accounts can share a cache_dir.
+    def _load_past_year(self, year):
+        if self.cache == None:
+            return None
+        data = self.cache.get_permanent(self._past_year_name(year))
+        if data == None:
+            return None
+        return load_binary(data, self)
+
+    def _save_past_year(self, year, modules):
+        if self.cache != None:
+            self.cache.put_permanent(self._past_year_name(year),
+                    dump_binary(modules))
+
+    def _past_year_name(self, year):
+        return "modules-%s-%s" % (_user_key(self.user), year)
+
+    # Generator versions of get_modules and friends, for going through a lot
+    # of MMS without holding all of it in memory. Nothing is fetched until
+    # it's needed, and objects are yielded as soon as they're parsed.
+    def iter_modules(self, academic_year=None):
+        for module in self._iter_parsed(_modules_url(academic_year),
+                _parse_modules_list, _iter_modules_list, self,
+                self.fast_parse):
+            self._index_modules([module], academic_year)
+            yield module
+
+    # Yields (module, tool, assignment) for every assignment in every
+    # coursework tool of the given modules (by default, this year's).
+    def iter_assignments(self, modules=None):
+        if modules == None:
+            modules = self.iter_modules()
+        for module in modules:
+            for tool in module.get_tools(MMSToolType.Coursework):
+                for assignment in tool.iter_assignments():
+                    yield (module, tool, assignment)
+
+    # Yields (assignment, feedback) for each of the given assignments, with
+    # feedback as returned by fetch_feedback.
+    def iter_feedback(self, assignments):
+        for assignment in assignments:
+            yield (assignment, self.fetch_feedback(assignment._feedback_urls))
+
+    # Maps func over items on up to max_workers threads, returning the results
+    # in order. Useful for crawling several tools or modules at once.
+    def map_concurrent(self, func, items):
+        return self._pool_map(_MAP_POOL, func, items)
+
+    # Fetches each of the given feedback URLs, up to max_workers at a time.
+    # Results come back in the same order as the URLs; a URL which fails is
+    # returned as a FetchError rather than aborting the batch.
+    def fetch_feedback(self, feedback_urls):
+        return self._fetch_all(lambda url: _fetch_feedback(url, self),
+                feedback_urls)
+
+    # As fetch_feedback, for assignments' chart links. Each chart comes back
+    # as a list of grades, see _parse_chart.
+    def fetch_charts(self, chart_urls):
+        return self._fetch_all(lambda url: _fetch_chart(url, self), chart_urls)
+
+    # Applies fetch_fn to each URL on a bounded thread pool, sharing self.sess.
+    def _fetch_all(self, fetch_fn, urls):
+        def fetch_one(url):
+            try:
+                return fetch_fn(url)
+            except Exception as e:
+                return FetchError(url, e)
+        return self._pool_map(_FETCH_POOL, fetch_one, urls)
+
+    # Maps func over items on the given level's pool of max_workers threads,
+    # preserving the order of the results. Starting threads costs more than a
+    # small batch saves, so the pools are kept from one batch to the next.
+    # Batches can nest (crawling tools, then each tool's feedback), and a pool
+    # whose workers wait on a batch in the same pool can deadlock. So a batch
+    # started from a worker of the same or a later level runs inline instead.
+    def _pool_map(self, level, func, items):
+        items = list(items)
+        if self.max_workers <= 1 or len(items) <= 1 or \
+                getattr(self._pool_local, "level", -1) >= level:
+            return map(func, items)
+        with self._pools_lock:
+            pool = self._pools.get(level)
+            if pool == None:
+                pool = ThreadPool(self.max_workers, self._start_pool_worker,
+                        (level,))
+                self._pools[level] = pool
+        return pool.map_async(func, items).get(_POOL_TIMEOUT)
+
+    def _start_pool_worker(self, level):
+        self._pool_local.level = level
+
+    # Gets a single MMSModule from its own page, rather than the whole modules
+    # list. Returns None if there's no such module that year.
+    # The page's URL includes the semester, which only the modules list tells
+    # us, so the first lookup in a year has to fetch that year's list. Every
+    # lookup after that is a single request.
     def get_module(self, academic_year, module_code):
-        # TODO. Will require going to module page, and translating
-        # from textual reps of tools to actual tools, parsing a different table 
-        pass
+        key = (academic_year, module_code)
+        if key not in self._module_urls:
+            self.get_modules(academic_year)
+            if key not in self._module_urls:
+                return None
+        url = self._module_urls[key]
+        return self._get_parsed(url, _parse_module_page, url, self,
+                self.fast_parse)
+
+
+
+# A page as MMS sent it, in bytes, along with the charset the response's
+# Content-Type declared (or None if it didn't, in which case the parsers go by
+# the page's own <meta charset>, or UTF-8 for JSON). The parsers decode these
+# as they go, so the page is never copied out to unicode and back.
+class MMSPage(str):
+    def __new__(cls, content, encoding=None):
+        page = str.__new__(cls, content)
+        page.encoding = encoding
+        return page
+
+def _modules_url(academic_year=None):
+    # https://mms.st-andrews.ac.uk/mms/user/me/Modules?academic_year=2011%2F2
+    req_url = MMSLib.BASE_URL + "/mms/user/me/Modules?academic_year="
+    if academic_year != None:
+        academic_year = academic_year.replace("_", "%2F")
+        req_url = req_url + academic_year
+
+    return req_url + "&unit=&command=Get+My+Modules"
+
+def _module_url(academic_year, semester, module_code):
+    # https://mms.st-andrews.ac.uk/mms/module/2013_4/S1/CS4102/
+    return MMSLib.BASE_URL + "/mms/module/%s/%s/%s/" % \
+            (academic_year, semester, module_code)
+
+def _clean_html(text):
+    ## RAWR!!!! >=[
+    # Unicode is being incredibly annoying, and I can't fix it. So ASCII
+    # for now. Sorry, languages students.
+    html = text.encode("ascii", "ignore")
+    html = html.replace("&#160;", "")
+    # html = unescape(html)
+    return html
 
+def _download_filename(url, headers):
+    # Default to the filename...
+    local_filename = url.split('/')[-1]
+    # But if we can, get the nice name instead :)
+    if "content-disposition" in headers:
+        content_disp = headers.get("content-disposition")
+        local_filename = content_disp.split("filename=")[1].replace("\"","")
+    return local_filename
 
+# The charset a response's Content-Type declares, or None. Not requests'
+# resp.encoding, which falls back to ISO-8859-1 for any text/html.
+def _declared_encoding(headers):
+    return cgi.parse_header(headers.get("content-type", ""))[1].get("charset")
 
-def _parse_modules_list(html, lib):
+# A name for user which is safe to use in file names and cache keys
+def _user_key(user):
+    if isinstance(user, unicode):
+        user = user.encode("utf-8")
+    return hashlib.sha256(user).hexdigest()[:16]
+
+# What kind of MMS page url is, for stats and the object cache's TTLs. Goes by
+# the shapes of URL the parsers produce: the modules list, a module's page
+# (/mms/module/2013_4/S1/CS4102/), a tool's page below that (Coursework/, or
+# another tool's, which for us means a content listing), and the feedback,
+# chart and download links on a tool's page (?action=feedback, ?chart=,
+# ?download=).
+def _url_class(url):
+    (path, query) = urllib.splitquery(url)
+    if path.endswith("/mms/user/me/Modules"):
+        return "modules"
+    match = _MODULE_URL_RE.search(path)
+    if match == None:
+        return "other"
+    tool = match.group(1)
+    if tool == None:
+        return "module"
+    args = urlparse.parse_qs(query or "")
+    if args.get("action") == ["feedback"]:
+        return "feedback"
+    elif "chart" in args:
+        return "chart"
+    elif "download" in args:
+        return "download"
+    elif tool == "Coursework":
+        return "coursework"
+    return "content"
+
+# A module's page, or one of its tools' pages if there's a tool
+_MODULE_URL_RE = re.compile("/mms/module/[^/]+/[^/]+/[^/]+/(?:([^/]+)/)?$")
+
+# Statuses of the responses whose pages are worth keeping parsed, see
+# MMSLib._get_parsed. (A 304 is answered with a page from the response cache.)
+_CACHEABLE_STATUSES = (200, 304)
+
+# Downloads are streamed to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# The header to identify this version of a file by in If-Range: its ETag if
+# it has a strong one, or else its Last-Modified date. None if neither.
+def _validator(headers):
+    etag = headers.get("etag")
+    if etag != None and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified")
+
+# The validator for a .part file is kept in a file beside it
+def _read_validator(part_path):
+    try:
+        with open(part_path + ".validator") as f:
+            return f.read()
+    except IOError:
+        return None
+
+def _write_validator(part_path, validator):
+    if validator == None:
+        if os.path.exists(part_path + ".validator"):
+            os.remove(part_path + ".validator")
+        return
+    with open(part_path + ".validator", "w") as f:
+        f.write(validator)
+
+# Streams the response r to local_path's .part file (opened with mode, so "ab"
+# carries on with one), and then moves it into place with MMS' modification
+# time, so we can spot it next time. Returns the number of bytes written.
+def _save_download(r, local_path, mode="wb"):
+    num_bytes = 0
+    with open(local_path + ".part", mode) as f:
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            num_bytes += len(chunk)
+    _finish_part(local_path)
+    last_modified = _parse_http_date(r.headers.get("last-modified"))
+    if last_modified != None:
+        os.utime(local_path, (last_modified, last_modified))
+    return num_bytes
+
+# Whether a mirrored file is still as it was downloaded, see mirror
+def _is_mirrored(dest_dir, entry):
+    path = os.path.join(dest_dir, entry["path"])
+    return os.path.exists(path) and os.path.getsize(path) == entry["size"]
+
+# Moves a finished download into place
+def _finish_part(local_path):
+    os.rename(local_path + ".part", local_path)
+    _write_validator(local_path + ".part", None)
+
+# A directory name for an assignment's submission, see download_submissions
+def _submission_dir(assignment):
+    match = _SUBMISSION_MODULE_RE.search(assignment.submission_url)
+    if match == None:
+        return str(assignment.id)
+    (academic_year, semester, module_code) = match.groups()
+    return "%s-%s-%s" % (module_code, academic_year, assignment.id)
+
+# /mms/module/2013_4/S1/CS4102/Coursework/?download=...
+_SUBMISSION_MODULE_RE = re.compile("/mms/module/([^/]+)/([^/]+)/([^/]+)/")
+
+# Whether the file at local_path is the one described by the headers
+def _is_downloaded(local_path, headers):
+    if not os.path.exists(local_path):
+        return False
+    size = headers.get("content-length")
+    if size == None or int(size) != os.path.getsize(local_path):
+        return False
+    last_modified = _parse_http_date(headers.get("last-modified"))
+    return last_modified == None or \
+            int(os.path.getmtime(local_path)) == last_modified
+
+# Returns an HTTP date as seconds since the epoch, or None
+def _parse_http_date(date_str):
+    if date_str == None:
+        return None
+    date_tuple = email.utils.parsedate_tz(date_str)
+    if date_tuple == None:
+        return None
+    return email.utils.mktime_tz(date_tuple)
+
+# Long enough to never fire; waiting with a timeout keeps the pool
+# interruptible with Ctrl-C, which a plain Pool.map isn't in Python 2.
+_POOL_TIMEOUT = 60 * 60 * 24
+
+# Pool levels for MMSLib._pool_map. map_concurrent's batches are the outer
+# ones, and the batch methods' (fetch_feedback and friends) run inside them.
+_MAP_POOL = 0
+_FETCH_POOL = 1
+
+def _attach_all(value, lib):
+    if isinstance(value, list):
+        for item in value:
+            _attach_all(item, lib)
+    elif isinstance(value, MMSObject):
+        value.attach(lib)
+
+# /mms/module/2013_4/Y1/CS4099/
+_MODULE_LINK_RE = re.compile("/mms/module/(.+)/(.+)/(.+)/")
+# 25 %
+_WEIGHTING_RE = re.compile("(\d*) %")
+
+def _make_soup(html, fast=False, parse_only=None):
+    """ Parses html with BeautifulSoup. If fast is set, lxml is used, and only
+    the elements matched by the parse_only strainer are built. """
+    encoding = None
+    if isinstance(html, MMSPage):
+        encoding = html.encoding
+    if fast:
+        return BeautifulSoup(html, "lxml", parse_only=parse_only,
+                from_encoding=encoding)
+    return BeautifulSoup(html, from_encoding=encoding)
+
+def _has_class(class_attr, class_name):
+    # Attributes seen by a SoupStrainer haven't been split into lists yet
+    if isinstance(class_attr, basestring):
+        class_attr = class_attr.split()
+    return class_attr != None and class_name in class_attr
+
+def _is_module_part(name, attrs):
+    return (name == "h3" and _has_class(attrs.get("class"), "module_heading")) \
+        or (name == "ul" and _has_class(attrs.get("class"), "module_resources"))
+
+def _parse_modules_list(html, lib, fast=False):
     """ Given a module overview page, parses the page into a list of MMSModules """
-    ret = []
-    parser = BeautifulSoup(html)
+    return list(_iter_modules_list(html, lib, fast))
+
+def _iter_modules_list(html, lib, fast=False):
+    """ As _parse_modules_list, but yields each MMSModule as it's parsed. """
+    if fast:
+        for mms_module in _iter_modules_list_fast(html, lib):
+            yield mms_module
+        return
+    parser = _make_soup(html)
 
     modules_entries = parser.findAll("h3", { "class" : "module_heading" })
     for entry in modules_entries: # enumerates all modules
         # Get link, which gives us easy access to reasonably juicy info
         link = entry.a["href"]
-        # /mms/module/2013_4/Y1/CS4099/
-        regex = "/mms/module/(.+)/(.+)/(.+)/"
-        match = re.search(regex, link)
+        match = _MODULE_LINK_RE.search(link)
         if match:
             # If we've got a module match, process the subgroups to get metadata
             academic_year = match.group(1)
             semester = match.group(2)
             code = match.group(3)
-            name = entry.a.contents[0]
+            name = unicode(entry.a.contents[0])
 
             # Then parse the tools
             tools = _parse_module_tools(entry, lib)
 
-            mms_module = MMSModule(code, name, semester, tools)
-            ret.append(mms_module)
-    return ret
+            yield MMSModule(code, name, semester, tools, academic_year)
+
+def _iter_modules_list_fast(html, lib):
+    """ As _iter_modules_list, but only builds the module headings and tool
+    lists. These come out flat and in page order, so each tool list belongs to
+    the heading before it, and a module is done once the next heading comes. """
+    parser = _make_soup(html, True, SoupStrainer(_is_module_part))
+
+    mms_module = None
+    for entry in parser.find_all(_is_module_part_tag, recursive=False):
+        if entry.name == "h3":
+            if mms_module != None:
+                yield mms_module
+            mms_module = None
+            match = _MODULE_LINK_RE.search(entry.a["href"])
+            if match:
+                mms_module = MMSModule(match.group(3),
+                        unicode(entry.a.contents[0]), match.group(2), [],
+                        match.group(1))
+        elif mms_module != None and len(mms_module.tools) == 0:
+            mms_module.tools = _parse_tool_links(entry, lib)
+    if mms_module != None:
+        yield mms_module
+
+def _is_module_part_tag(tag):
+    return _is_module_part(tag.name, tag.attrs)
 
 def _parse_module_tools(dom_entry, lib):
-    tools = []
     section = dom_entry.next_sibling.next_sibling # 2x nextSibling. why? beats me.
     tool_section = section.find("ul", { "class" : "module_resources"})
     if tool_section:
-        tool_links = tool_section.find_all("a")
-        for tool_link in tool_links:
-            #print "tl", tool_link
-            tool_class = tool_link["class"][1]
-            # Get the data we need, create an MMSTool instance
-            tool_type = MMSToolType.from_string(tool_class)
-            link = MMSLib.BASE_URL + tool_link["href"]
-            tool_name = tool_link.contents[0]
-            # TODO: Once we add support for more tools, it's likely that it'd be
-            # best to have subclasses for each tool, like this. For now, this will do...
-            if tool_type == MMSToolType.Coursework:
-                tool = MMSCourseworkTool(tool_name, link, lib)
-            else:
-                tool = MMSTool(tool_name, tool_type, link, lib)
-            tools.append(tool)
+        return _parse_tool_links(tool_section, lib)
+    return []
+
+def _parse_tool_links(tool_section, lib):
+    tools = []
+    tool_links = tool_section.find_all("a")
+    for tool_link in tool_links:
+        #print "tl", tool_link
+        tools.append(_parse_tool_link(tool_link, lib))
 
     return tools
 
-def _parse_login(html):
+def _parse_tool_link(tool_link, lib):
+    tool_class = tool_link["class"][1]
+    # Get the data we need, create an MMSTool instance
+    tool_type = MMSToolType.from_string(tool_class)
+    link = MMSLib.BASE_URL + tool_link["href"]
+    tool_name = unicode(tool_link.contents[0])
+    # TODO: Once we add support for more tools, it's likely that it'd be
+    # best to have subclasses for each tool, like this. For now, this will do...
+    if tool_type == MMSToolType.Coursework:
+        return MMSCourseworkTool(tool_name, link, lib)
+    elif tool_type == MMSToolType.Content:
+        return MMSContentTool(tool_name, link, lib)
+    return MMSTool(tool_name, tool_type, link, lib)
+
+def _is_module_page_part(name, attrs):
+    return name == "h2" or \
+        (name == "a" and _has_class(attrs.get("class"), "resource"))
+
+def _parse_module_page(html, url, lib, fast=False):
+    """ Parses a module's own page into an MMSModule. The year, semester and
+    code come from the URL, the name from the page heading, and the tools from
+    the resource links, which are marked up as on the modules list. """
+    parser = _make_soup(html, fast, SoupStrainer(_is_module_page_part))
+    match = _MODULE_LINK_RE.search(url)
+    # CS4102 - Computer Graphics
+    name = None
+    heading = parser.find("h2")
+    if heading != None:
+        name = heading.get_text().split(":")[0].strip()
+
+    tools = []
+    for tool_link in parser.find_all("a"):
+        if _has_class(tool_link.get("class"), "resource"):
+            tools.append(_parse_tool_link(tool_link, lib))
+    return MMSModule(match.group(3), name, match.group(2), tools,
+            match.group(1))
+
+def _parse_content(html, url, fast=False):
+    """ Parses a content tool's page into a list of MMSContentFiles. Files are
+    linked relative to the tool, as ?... (like coursework submissions), which
+    sets them apart from the navigation links. """
+    parser = _make_soup(html, fast, SoupStrainer("a"))
+    files = []
+    for file_link in parser.find_all("a", href=True):
+        if file_link["href"].startswith("?"):
+            files.append(MMSContentFile(file_link.get_text().strip(),
+                url + file_link["href"]))
+    return files
+
+def _parse_academic_years(html, fast=False):
+    """ Parses the academic year drop-down on the modules page. Returns the
+    years on offer, oldest first, and the one currently selected, all in the
+    form used in module URLs (2013_4). """
+    parser = _make_soup(html, fast,
+            SoupStrainer("select", { "name" : "academic_year" }))
+    select = parser.find("select", { "name" : "academic_year" })
+    years = []
+    current = None
+    if select != None:
+        for option in select.find_all("option"):
+            year = option["value"].replace("/", "_")
+            years.append(year)
+            if option.has_attr("selected"):
+                current = year
+    years.sort()
+    if current == None and len(years) > 0:
+        current = years[-1]
+    return (years, current)
+
+def _parse_login(html, fast=False):
     """Parses the login page. Returns a dictionary of the form { id : form id,
     dest : destination url, lt : lt hidden value, eventid : eventId hidden value}."""
-    parser = BeautifulSoup(html)
+    parser = _make_soup(html, fast, SoupStrainer("form"))
     # Extracts required information from the page
     form = parser.find("form")
     id = form["id"]
@@ -337,6 +1903,16 @@ def _parse_login(html):
     return { "id" : id, "dest" : action_url, "lt" : lt_hidden, \
              "eventid" : eid_hidden }
 
+# The text of a table cell, or None if it's empty. Cells MMS leaves blank
+# hold a &#160;, which counts as empty too.
+def _cell_text(dom_element):
+    if len(dom_element.contents) == 0:
+        return None
+    text = dom_element.contents[0].strip()
+    if len(text) == 0:
+        return None
+    return text
+
 def is_float(test_str):
     try:
         float(test_str)
@@ -344,9 +1920,12 @@ def is_float(test_str):
     except ValueError:
         return False
 
-def _parse_cwk(html, url, lib):
-    ret = []
-    parser = BeautifulSoup(html)
+def _parse_cwk(html, url, lib, fast=False):
+    return list(_iter_cwk(html, url, lib, fast))
+
+# As _parse_cwk, but yields each MMSAssignment as its row is parsed
+def _iter_cwk(html, url, lib, fast=False):
+    parser = _make_soup(html, fast, SoupStrainer("tbody"))
     table = parser.find("tbody")
     entries = table.findAll("tr") # finds a list of all coursework elements
 
@@ -367,8 +1946,8 @@ def _parse_cwk(html, url, lib):
             file_url = url + file_url_field.a["href"]
         # 30 Sep 10, 23:59
         # Parse submission date. Not always present...
-        if len(children[4].contents) > 0:
-            submitted_date_str = children[4].contents[0]
+        submitted_date_str = _cell_text(children[4])
+        if submitted_date_str != None:
             try:
                 submitted_date = time.strptime(submitted_date_str, "%d %b %y, %H:%M")
             except ValueError: # Generally happens if not submitted
@@ -380,8 +1959,8 @@ def _parse_cwk(html, url, lib):
 
         # Parse grade
         grade = None
-        if len(children[6].contents) > 0:
-            grade_str = children[6].contents[0]
+        grade_str = _cell_text(children[6])
+        if grade_str != None:
             if is_float(grade_str):
                 grade = float(grade_str)
 
@@ -389,8 +1968,7 @@ def _parse_cwk(html, url, lib):
         weighting_str = children[7].contents[0]
         weighting = None
         try:
-            weighting_regex = "(\d*) %"
-            match = re.search(weighting_regex, weighting_str)
+            match = _WEIGHTING_RE.search(weighting_str)
             if match:
                 weighting = float(match.group(1))
         except ValueError:
@@ -399,15 +1977,14 @@ def _parse_cwk(html, url, lib):
         # Parse chart link. Some modules might not have charts enabled...
         chart_link = None
         if children[8].a != None:
-            chart_link = str(children[8].a["href"])
+            chart_link = url + str(children[8].a["href"])
 
         id = int(children[9].input["value"])
-        assignment = MMSAssignment(id, str(name), due_date, feedback_date, \
+        assignment = MMSAssignment(id, unicode(name), due_date, feedback_date, \
                         submitted_date, file_url, feedback, grade, \
                         weighting, chart_link, lib)
         #print assignment
-        ret.append(assignment)
-    return ret
+        yield assignment
 
 # The feedback field gives us a URL to the feedback. Adding the parameter
 # template_format=application/json gives us the data in a nice JSON format to use.
@@ -426,19 +2003,24 @@ def _parse_cwk_feedback_field(dom_element, url):
 
 # Woo, if only all of MMS had a JSON API! Would make my life easier :)
 def _fetch_feedback(feedback_url, lib):
-    json_data = lib._mms_get(feedback_url)
+    return lib._get_parsed(feedback_url, _parse_feedback)
+
+# A backslash, and the quote it's escaping if it's escaping one
+_FEEDBACK_ESCAPE_RE = re.compile(r'\\(")?')
+# Lets through raw control characters (newlines, tabs) inside strings
+_FEEDBACK_DECODER = json.JSONDecoder(strict=False)
+
+def _parse_feedback(json_data):
     # The JSON passed back from MMS isn't valid JSON. Boo.
     # Some characters are escaped with \ when they shouldn't be. When things
     # *are* escaped, they're only escaped with one backslash.
-    # Nightmare. This is a hack, because I hate dealing with this mess and my
-    # original regex didn't work. Even though it was correct. Gah.
-    formatted_json = json_data.replace("\\\"", "<<quote>>")
-    formatted_json = formatted_json.replace("\\", "\\\\")
-    formatted_json = formatted_json.replace("<<quote>>", "\\\"")
-
-    #print formatted_json
-    feedback_data = json.loads(formatted_json)
-    #feedback_data = json.loads(json_data)
+    # So quotes keep their backslash, and every other backslash is taken
+    # literally, all in one pass.
+    if isinstance(json_data, MMSPage):
+        json_data = json_data.decode(json_data.encoding or "utf-8", "replace")
+    formatted_json = _FEEDBACK_ESCAPE_RE.sub(_escape_feedback_backslash,
+            json_data)
+    feedback_data = _FEEDBACK_DECODER.decode(formatted_json)
     date = time.strptime(feedback_data["feedback_date"], "%d/%m/%Y %H:%M")
     comment = None
     file_url = None
@@ -450,9 +2032,47 @@ def _fetch_feedback(feedback_url, lib):
     return MMSFeedback(feedback_data["sender_name"], date, \
             comment, file_url)
 
+# As with feedback, asking for the chart as JSON gets us its data rather
+# than a picture.
+def _fetch_chart(chart_url, lib):
+    return lib._parse(_parse_chart,
+            lib._mms_get(chart_url + "&template_format=application/json"))
+
+def _parse_chart(json_data):
+    """ Parses a grade distribution chart into a list of the grades in it.
+    We've no example of the chart data to go on, so this takes the shapes it's
+    likely to be in: a list of grades, a list of [grade, count] pairs, or
+    either of those under "grades", "data" or "values". """
+    if isinstance(json_data, MMSPage):
+        json_data = json_data.decode(json_data.encoding or "utf-8", "replace")
+    chart_data = _FEEDBACK_DECODER.decode(json_data)
+    if isinstance(chart_data, dict):
+        for key in ("grades", "data", "values"):
+            if key in chart_data:
+                chart_data = chart_data[key]
+                break
+        else:
+            raise ValueError("Unrecognised chart data")
+    grades = []
+    for entry in chart_data:
+        if isinstance(entry, list):
+            (grade, count) = entry
+            grades.extend([float(grade)] * int(count))
+        else:
+            grades.append(float(entry))
+    return grades
+
+def _escape_feedback_backslash(match):
+    if match.group(1) != None:
+        return "\\\""
+    return "\\\\"
+
 def unescape(s):
     p = htmllib.HTMLParser(None)
     p.save_bgn()
     p.feed(s)
     return p.save_end()
 
+# The parsers which MMSLib sends to its parse pool. The rest are too quick to
+# be worth the trip.
+_PROCESS_PARSERS = (_parse_cwk, _parse_modules_list, _parse_module_page)
@@ -0,0 +1,241 @@
+# Asynchronous access to St Andrews MMS, for use from inside an event loop.
+# Same idea as MMSLib, and hands back the same MMSModule / MMSAssignment /
+# MMSFeedback objects, but every request is a Tornado coroutine. So you can
+# have thousands of requests on the go at once, over a bounded set of
+# connections, without a thread for each of them.
+#
+# The connections are only kept alive between requests if pycurl is installed.
+# Without it we fall back to Tornado's simple client, which opens a new
+# connection for every request (still no more than max_clients at once), and
+# warn about it on import.
+#
+# Objects returned from here hold the AsyncMMSLib as their lib, so use the
+# coroutines on AsyncMMSLib (get_assignments, get_feedback, ...) rather than
+# the blocking methods on the objects themselves.
+#
+#   @gen.coroutine
+#   def grades():
+#       lib = yield AsyncMMSLib.connect(user, passwd)
+#       for module in (yield lib.get_modules()):
+#           ...
+#
+#   IOLoop.current().run_sync(grades)
+from mmslib import MMSLib, AuthenticationError, CourseworkNotAvailableError, \
+    FetchError, _clean_html, _download_filename, _modules_url, _parse_cwk, \
+    _parse_feedback, _parse_login, _parse_modules_list
+from requests.cookies import RequestsCookieJar, MockRequest, MockResponse, \
+    get_cookie_header
+from requests.utils import get_encoding_from_headers
+from tornado import gen, locks
+from tornado.httpclient import HTTPError, HTTPRequest
+import os
+import os.path
+import tempfile
+import urllib
+import urlparse
+import warnings
+
+# The curl client keeps connections alive between requests, the simple client
+# doesn't. So use curl if we've got it.
+try:
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as _HTTPClient
+except ImportError:
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as _HTTPClient
+    warnings.warn("pycurl isn't installed, so AsyncMMSLib will open a new "
+            "connection for every request")
+
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307)
+
+class AsyncMMSLib(object):
+    # max_clients is the number of requests which can be in flight at once;
+    # anything over that is queued up by the HTTP client.
+    def __init__(self, user, passwd, max_clients=100, fast_parse=False,
+            request_timeout=60):
+        self.user = user
+        self.passwd = passwd
+        self.fast_parse = fast_parse
+        self.request_timeout = request_timeout
+        self.cookies = RequestsCookieJar()
+        self.http = _HTTPClient(force_instance=True, max_clients=max_clients)
+        # See MMSLib._relogin
+        self._login_lock = locks.Lock()
+        self._login_generation = 0
+
+    # Creates a library instance and logs in, like MMSLib's constructor does.
+    @classmethod
+    @gen.coroutine
+    def connect(cls, user, passwd, **kwargs):
+        lib = cls(user, passwd, **kwargs)
+        yield lib._mms_get(MMSLib.BASE_URL + "/mms/user/me/Modules")
+        raise gen.Return(lib)
+
+    def close(self):
+        self.http.close()
+
+    # Makes a request, following redirects ourselves so that we can pick up
+    # the cookies the SSO system sets along the way. If stream_to is given,
+    # the body is written to that file rather than kept in memory.
+    @gen.coroutine
+    def _fetch(self, url, method="GET", body=None, stream_to=None):
+        streaming_callback = None
+        if stream_to != None:
+            streaming_callback = stream_to.write
+
+        for i in range(MAX_REDIRECTS):
+            headers = {}
+            cookie = get_cookie_header(self.cookies, _CookieRequest(url))
+            if cookie != None:
+                headers["Cookie"] = cookie
+            req = HTTPRequest(url, method=method, body=body, headers=headers,
+                    follow_redirects=False, request_timeout=self.request_timeout,
+                    streaming_callback=streaming_callback)
+            resp = yield self.http.fetch(req, raise_error=False)
+            # 599 means we never got a response at all
+            if resp.code == 599:
+                raise resp.error
+            self.cookies.extract_cookies(
+                    MockResponse(_CookieHeaders(resp.headers)),
+                    MockRequest(_CookieRequest(url)))
+
+            if resp.code not in REDIRECT_CODES or "Location" not in resp.headers:
+                raise gen.Return(resp)
+            url = urlparse.urljoin(url, resp.headers["Location"])
+            if resp.code != 307:
+                method = "GET"
+                body = None
+            if stream_to != None: # Throw away the body of the redirect
+                stream_to.seek(0)
+                stream_to.truncate()
+        raise IOError("Too many redirects fetching %s" % url)
+
+    @gen.coroutine
+    def _get_text(self, req_url):
+        resp = yield self._fetch(req_url)
+        raise gen.Return(_response_text(resp))
+
+    @gen.coroutine
+    def _login(self, login_page):
+        parsed_login = _parse_login(login_page, self.fast_parse)
+        args = { "username" : self.user, "password": self.passwd,
+                 "lt" : parsed_login["lt"], "_eventId" : parsed_login["eventid"] }
+
+        req_url = MMSLib.LOGIN_URL + "/" + parsed_login["dest"]
+        resp = yield self._fetch(req_url, "POST", urllib.urlencode(args))
+        text = _response_text(resp)
+        if MMSLib.INCORRECT_TEXT in text:
+            raise AuthenticationError()
+        raise gen.Return(text)
+
+    @gen.coroutine
+    def _relogin(self, login_generation, login_page):
+        with (yield self._login_lock.acquire()):
+            if self._login_generation == login_generation:
+                yield self._login(login_page)
+                self._login_generation += 1
+
+    # As MMSLib._mms_get
+    @gen.coroutine
+    def _mms_get(self, req_url):
+        login_generation = self._login_generation
+        text = yield self._get_text(req_url)
+        if MMSLib.NOT_LOGGED_IN_TEXT in text:
+            yield self._relogin(login_generation, text)
+            text = yield self._get_text(req_url)
+            if MMSLib.NOT_LOGGED_IN_TEXT in text:
+                raise AuthenticationError()
+        raise gen.Return(_clean_html(text))
+
+    # Downloads url into dest_dir, streaming it straight to disk. Returns the
+    # path of the downloaded file. Raises an HTTPError (and keeps nothing) if
+    # MMS answers with an error.
+    @gen.coroutine
+    def _mms_download(self, url, dest_dir="."):
+        (fd, tmp_path) = tempfile.mkstemp(dir=dest_dir, prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                resp = yield self._fetch(url, stream_to=f)
+            if resp.code >= 400:
+                raise HTTPError(resp.code, response=resp)
+            local_path = os.path.join(dest_dir,
+                    _download_filename(url, resp.headers))
+            os.rename(tmp_path, local_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise gen.Return(local_path)
+
+    # Gets a list of MMSModules.
+    # If academic_year is None, the current year is fetched.
+    @gen.coroutine
+    def get_modules(self, academic_year=None):
+        res = yield self._mms_get(_modules_url(academic_year))
+        raise gen.Return(_parse_modules_list(res, self, self.fast_parse))
+
+    @gen.coroutine
+    def get_assignments(self, cwk_tool):
+        cwk_page = yield self._mms_get(cwk_tool.url)
+        raise gen.Return(_parse_cwk(cwk_page, cwk_tool.url, self,
+            self.fast_parse))
+
+    # Fetches all of the given feedback URLs at once. As with
+    # MMSLib.fetch_feedback, failed URLs come back as FetchErrors.
+    @gen.coroutine
+    def fetch_feedback(self, feedback_urls):
+        feedback = yield [self._fetch_feedback(url) for url in feedback_urls]
+        raise gen.Return(feedback)
+
+    @gen.coroutine
+    def _fetch_feedback(self, feedback_url):
+        try:
+            json_data = yield self._mms_get(feedback_url)
+            feedback = _parse_feedback(json_data)
+        except Exception as e:
+            feedback = FetchError(feedback_url, e)
+        raise gen.Return(feedback)
+
+    @gen.coroutine
+    def get_feedback(self, assignment):
+        feedback = yield self.fetch_feedback(assignment._feedback_urls)
+        for entry in feedback:
+            if isinstance(entry, FetchError):
+                raise entry.error
+        raise gen.Return(feedback)
+
+    # As MMSCourseworkTool.get_all_feedback
+    @gen.coroutine
+    def get_all_feedback(self, cwk_tool, assignments=None):
+        if assignments == None:
+            assignments = yield self.get_assignments(cwk_tool)
+        feedback = yield [self.fetch_feedback(assignment._feedback_urls) \
+                for assignment in assignments]
+        raise gen.Return(feedback)
+
+    @gen.coroutine
+    def download_submission(self, assignment, dest_dir="."):
+        if assignment.submission_url == None:
+            raise CourseworkNotAvailableError
+        path = yield self._mms_download(assignment.submission_url, dest_dir)
+        raise gen.Return(path)
+
+def _response_text(resp):
+    encoding = get_encoding_from_headers(resp.headers) or "utf-8"
+    return (resp.body or "").decode(encoding, "replace")
+
+# Just enough of a request and a response for cookielib to work with, by way
+# of requests' MockRequest and MockResponse.
+class _CookieRequest(object):
+    def __init__(self, url):
+        self.url = url
+        self.headers = {}
+
+class _CookieHeaders(object):
+    def __init__(self, headers):
+        self._headers = headers
+
+    def getheaders(self, name):
+        return self._headers.get_list(name)
+
+    def get_all(self, name, default=None):
+        return self._headers.get_list(name) or default
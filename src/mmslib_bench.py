@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Offline benchmarks for the mmslib parsers.
+# Runs each parser over the anonymised pages in fixtures/, scaled up to a few
+# different sizes, and reports throughput and peak memory. No network access
+# or MMS credentials needed, so parser changes can be compared anywhere.
+from mmslib import _clean_html, _parse_cwk, _parse_cwk_feedback_field, \
+    _parse_feedback, _parse_login, _parse_module_tools, _parse_modules_list
+from bs4 import BeautifulSoup
+from multiprocessing import Process, Queue
+from Queue import Empty
+import os.path
+import resource
+import sys
+import time
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "fixtures")
+# Each page is benchmarked as recorded, and with its repeated part (module
+# entries, coursework rows) copied this many times over.
+SIZES = [1, 10, 100]
+# Keep running each benchmark for at least this long, in seconds
+MIN_TIME = 0.5
+CWK_URL = "https://mms.st-andrews.ac.uk/mms/module/2013_4/S1/CS4102/Coursework/"
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name)) as f:
+        return f.read().decode("utf-8")
+
+# Repeats the part of page between start and end (exclusive) scale times.
+def scale_page(page, start, end, scale):
+    start_idx = page.index(start)
+    end_idx = page.index(end, start_idx)
+    return page[:start_idx] + page[start_idx:end_idx] * scale + page[end_idx:]
+
+def modules_page(scale):
+    page = load_fixture("modules.html")
+    return _clean_html(scale_page(page, "<h3 class=\"module_heading\">",
+        "</div>\n<div id=\"footer\">", scale))
+
+def cwk_page(scale):
+    page = load_fixture("cwk.html")
+    return _clean_html(scale_page(page, "<tr>\n<td>", "</tbody>", scale))
+
+# Each benchmark is set up by one of these, which returns a function to time
+# and the number of items (modules, rows, ...) it gets through per call.
+def bench_modules_list(scale, fast):
+    html = modules_page(scale)
+    count = len(_parse_modules_list(html, None, fast))
+    return (lambda: _parse_modules_list(html, None, fast), count)
+
+def bench_module_tools(scale, fast):
+    parser = BeautifulSoup(modules_page(scale))
+    entries = parser.findAll("h3", { "class" : "module_heading" })
+    def run():
+        for entry in entries:
+            _parse_module_tools(entry, None)
+    return (run, len(entries))
+
+def bench_cwk(scale, fast):
+    html = cwk_page(scale)
+    count = len(_parse_cwk(html, CWK_URL, None, fast))
+    return (lambda: _parse_cwk(html, CWK_URL, None, fast), count)
+
+def bench_cwk_feedback_field(scale, fast):
+    parser = BeautifulSoup(cwk_page(scale))
+    cells = [row.findAll("td")[5] for row in parser.find("tbody").findAll("tr")]
+    def run():
+        for cell in cells:
+            _parse_cwk_feedback_field(cell, CWK_URL)
+    return (run, len(cells))
+
+def bench_login(scale, fast):
+    html = _clean_html(load_fixture("login.html"))
+    return (lambda: _parse_login(html, fast), 1)
+
+def bench_feedback_json(scale, fast):
+    json_data = _clean_html(load_fixture("feedback.json"))
+    return (lambda: _parse_feedback(json_data), 1)
+
+# (name, unit, setup function, whether it has a fast variant, scales)
+BENCHMARKS = [
+    ("_parse_modules_list", "modules", bench_modules_list, True, SIZES),
+    ("_parse_module_tools", "modules", bench_module_tools, False, SIZES),
+    ("_parse_cwk", "rows", bench_cwk, True, SIZES),
+    ("_parse_cwk_feedback_field", "cells", bench_cwk_feedback_field, False,
+        SIZES),
+    ("_parse_login", "pages", bench_login, True, [1]),
+    ("_fetch_feedback JSON repair", "docs", bench_feedback_json, False, [1]),
+]
+
+class ChildError(Exception):
+    pass
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Runs target(*(args + (results,))) in a child process of its own, so that
+# peak memory is per run, and returns what it puts on the results queue.
+# Raises a ChildError if the child exits without putting anything there, or
+# is still going after timeout seconds (if given).
+def run_in_child(target, args, timeout=None):
+    results = Queue()
+    proc = Process(target=target, args=args + (results,))
+    proc.start()
+    start = time.time()
+    try:
+        while True:
+            try:
+                return results.get(timeout=1)
+            except Empty:
+                pass
+            if not proc.is_alive():
+                # It may have got its result in just before exiting
+                try:
+                    return results.get(timeout=1)
+                except Empty:
+                    raise ChildError("exited with status %d" % proc.exitcode)
+            if timeout != None and time.time() - start > timeout:
+                proc.terminate()
+                raise ChildError("timed out after %ds" % timeout)
+    finally:
+        proc.join()
+
+def run_benchmark(setup, scale, fast, results):
+    start_rss = max_rss_kb()
+    (func, count) = setup(scale, fast)
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < MIN_TIME:
+        func()
+        calls += 1
+        elapsed = time.time() - start
+    results.put((calls / elapsed, calls * count / elapsed,
+        max_rss_kb() - start_rss))
+
+# Benchmarks run in a child process each, so that peak memory is per run
+def measure(setup, scale, fast):
+    return run_in_child(run_benchmark, (setup, scale, fast))
+
+def main():
+    backends = [False]
+    if "--default-only" not in sys.argv:
+        try:
+            import lxml
+            backends.append(True)
+        except ImportError:
+            print "lxml not installed, skipping the fast parser"
+
+    print "%-28s %-8s %5s %10s %20s %10s" % ("Parser", "Backend", "Scale",
+            "Pages/s", "Items/s", "Peak KiB")
+    for (name, unit, setup, has_fast, scales) in BENCHMARKS:
+        for fast in backends:
+            if fast and not has_fast:
+                continue
+            for scale in scales:
+                try:
+                    (pages_per_sec, items_per_sec, peak) = \
+                            measure(setup, scale, fast)
+                except ChildError as e:
+                    print "%-28s %-8s %5d failed: %s" % (name,
+                            "fast" if fast else "default", scale, e)
+                    continue
+                print "%-28s %-8s %5d %10.1f %20s %10d" % (name,
+                        "fast" if fast else "default", scale, pages_per_sec,
+                        "%.1f %s" % (items_per_sec, unit), peak)
+
+if __name__ == "__main__":
+    main()
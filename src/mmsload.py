@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# End to end load test for mmslib and mmspider, against the fake MMS in
+# mmsfake.py. Crawls a number of students' coursework at a few different
+# concurrency levels, through injected latency and errors, and reports
+# requests per second, request and crawl latency percentiles, and peak memory.
+# No network access or MMS credentials needed.
+#
+# Two crawls are run:
+#   mmslib    modules, then every coursework tool, its feedback, and the
+#             submissions (downloaded to a temporary directory)
+#   mmspider  mmspider's spider(), twice per student into a fresh SQLite store,
+#             as on its first and a later run
+from mmslib import MMSLib, MMSRequestEvent, MMSRetryEvent, MMSToolType
+from mmsfake import FakeMMSData, PASSWORD, start_server
+from mmslib_bench import ChildError, max_rss_kb, run_in_child
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+import mmspider
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+# Collects the latency of every request the crawls make
+class LatencyHook(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.retries = 0
+
+    def __call__(self, event):
+        with self._lock:
+            if isinstance(event, MMSRetryEvent):
+                self.retries += 1
+            elif isinstance(event, MMSRequestEvent):
+                self.latencies.append(event.latency)
+                if event.status == None or event.status >= 400:
+                    self.errors += 1
+
+def crawl_mmslib(lib, work_dir):
+    modules = lib.get_modules()
+    tools = [tool for module in modules \
+            for tool in module.get_tools(MMSToolType.Coursework)]
+    for (tool, assignments) in lib.map_concurrent(
+            lambda tool: (tool, tool.get_assignments()), tools):
+        tool.get_all_feedback(assignments)
+        lib.download_submissions(assignments, work_dir)
+
+def crawl_mmspider(lib, work_dir):
+    for i in range(2):
+        store = mmspider.open_store("sqlite", os.path.join(work_dir, ""))
+        try:
+            mmspider.spider(lib, store)
+            store.commit()
+        finally:
+            store.close()
+
+CRAWLS = [("mmslib", crawl_mmslib), ("mmspider", crawl_mmspider)]
+
+# The value below which p% of the sorted values fall
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))
+    return sorted_values[idx]
+
+# Crawls every user, options.clients at a time, each with its own MMSLib.
+def run_crawl(crawl, base_url, users, workers, options, results):
+    MMSLib.BASE_URL = base_url
+    MMSLib.LOGIN_URL = base_url
+    hook = LatencyHook()
+    work_dir = tempfile.mkdtemp(prefix="mmsload-")
+
+    def crawl_user(user):
+        start = time.time()
+        try:
+            lib = MMSLib(user, PASSWORD, max_workers=workers)
+            lib.add_hook(hook)
+            try:
+                crawl(lib, os.path.join(work_dir, user))
+            finally:
+                lib.close()
+        except Exception:
+            return None
+        return time.time() - start
+
+    pool = ThreadPool(options.clients)
+    start = time.time()
+    try:
+        for user in users:
+            os.makedirs(os.path.join(work_dir, user))
+        durations = pool.map(crawl_user, users)
+        elapsed = time.time() - start
+    finally:
+        pool.close()
+        shutil.rmtree(work_dir)
+
+    latencies = sorted(hook.latencies)
+    crawl_times = sorted(d for d in durations if d != None)
+    results.put({
+        "requests_per_sec" : len(latencies) / elapsed,
+        "latency" : [percentile(latencies, p) * 1000 for p in (50, 90, 99)],
+        "crawl" : [percentile(crawl_times, p) for p in (50, 99)],
+        "errors" : hook.errors,
+        "retries" : hook.retries,
+        "failed" : durations.count(None),
+        "peak_rss" : max_rss_kb(),
+    })
+
+# Each run happens in a child process of its own, so that peak memory is
+# per run
+def measure(crawl, base_url, users, workers, options):
+    return run_in_child(run_crawl, (crawl, base_url, users, workers, options),
+            options.timeout)
+
+# The fake MMS runs in a process of its own too, so it isn't competing with
+# the crawl for the GIL
+def serve(data, options, ready):
+    server = start_server(data, latency=options.latency / 1000.0,
+            error_rate=options.error_rate, expire_rate=options.expire_rate)
+    ready.put(server.base_url())
+    while True:
+        time.sleep(60)
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--students", type="int", default=8,
+            help="number of students to crawl [%default]")
+    parser.add_option("--clients", type="int", default=4,
+            help="students crawled at once [%default]")
+    parser.add_option("--workers", default="1,2,4,8",
+            help="MMSLib max_workers values to try [%default]")
+    parser.add_option("--latency", type="float", default=20,
+            help="mean server latency, in ms [%default]")
+    parser.add_option("--error-rate", type="float", default=0.02,
+            help="chance of a request failing with a 503 [%default]")
+    parser.add_option("--expire-rate", type="float", default=0.005,
+            help="chance of a request's session expiring [%default]")
+    parser.add_option("--timeout", type="int", default=600,
+            help="give up on a run after this many seconds [%default]")
+    parser.add_option("--crawl", action="append", choices=[name for \
+            (name, crawl) in CRAWLS], help="only run this crawl")
+    (options, args) = parser.parse_args()
+
+    data = FakeMMSData(students=options.students)
+    ready = Queue()
+    server = Process(target=serve, args=(data, options, ready))
+    server.daemon = True
+    server.start()
+    base_url = ready.get()
+    levels = [int(level) for level in options.workers.split(",")]
+
+    print "%-9s %7s %8s %8s %8s %8s %9s %9s %7s %7s %6s %9s" % ("Crawl",
+            "Workers", "Req/s", "p50 ms", "p90 ms", "p99 ms", "Crawl p50",
+            "Crawl p99", "Errors", "Retries", "Failed", "Peak KiB")
+    try:
+        for (name, crawl) in CRAWLS:
+            if options.crawl and name not in options.crawl:
+                continue
+            for workers in levels:
+                try:
+                    res = measure(crawl, base_url, data.users, workers,
+                            options)
+                except ChildError as e:
+                    print "%-9s %7d failed: %s" % (name, workers, e)
+                    continue
+                print "%-9s %7d %8.1f %8.1f %8.1f %8.1f %8.2fs %8.2fs " \
+                        "%7d %7d %6d %9d" % ((name, workers,
+                        res["requests_per_sec"]) + tuple(res["latency"]) +
+                        tuple(res["crawl"]) + (res["errors"], res["retries"],
+                        res["failed"], res["peak_rss"]))
+    finally:
+        server.terminate()
+
+if __name__ == "__main__":
+    main()
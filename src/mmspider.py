@@ -1,19 +1,36 @@
 #!/usr/bin/env python
 import ConfigParser
 from mmslib import *
+from multiprocessing.pool import ThreadPool
 import hashlib
+import heapq
+import json
+import random
 import shelve
 import smtplib
+import sqlite3
+import threading
+import time
+import traceback
 import os
 import os.path
+import whichdb
 
 CONF_FILE = "mmspider.conf"
 STORE_NAME = "mmspider.dat"
+SQLITE_STORE_NAME = "mmspider.sqlite"
+# Daemon mode defaults, see mmspider.conf.sample
+DEFAULT_INTERVAL = 15 * 60
+DEFAULT_JITTER = 60
+DEFAULT_DAEMON_WORKERS = 4
 SUBJECT_LINE = "MMSpider Alert: Coursework has changed"
 MSG_TEXT = "MMSpider has detected a change for some elements of coursework. " + \
         "These are detailed below."
 
-class PersistentCoursework(object):
+class PersistentCoursework(MMSObject):
+    __slots__ = ("id", "name", "due_date", "feedback_date", "feedback", "grade")
+    FIELDS = __slots__
+
     def __init__(self, id, name, due_date, feedback_date, feedback, grade):
         self.id = id
         self.name = name
@@ -22,9 +39,12 @@ class PersistentCoursework(object):
         self.feedback = feedback
         self.grade = grade
 
+    # feedback is the assignment's feedback, if it's already been fetched
     @staticmethod
-    def create_from_assignment(mms_assignment):
-        feedback = map(lambda x: str(x), mms_assignment.get_feedback())
+    def create_from_assignment(mms_assignment, feedback=None):
+        if feedback == None:
+            feedback = mms_assignment.get_feedback()
+        feedback = map(lambda x: str(x), feedback)
         ret = PersistentCoursework(mms_assignment.id, mms_assignment.name, \
                 mms_assignment.due_date, mms_assignment.feedback_date, \
                 feedback, mms_assignment.grade)
@@ -32,20 +52,421 @@ class PersistentCoursework(object):
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return self.to_dict() == other.to_dict()
         else:
             return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+# What's changed about one assignment since it was last seen. changes is a
+# list of [field, old, new], with the values already formatted for the email
+# (or None). Each feedback entry added or removed is a change of its own. A
+# new assignment is a change from nothing in every field it has.
+class CourseworkDiff(object):
+    def __init__(self, id, name, changes, new=False):
+        self.id = id
+        self.name = name
+        self.changes = changes
+        self.new = new
+
+    def to_dict(self):
+        return { "id" : self.id, "name" : self.name,
+                 "changes" : self.changes, "new" : self.new }
+
+    @staticmethod
+    def from_dict(fields):
+        return CourseworkDiff(fields["id"], fields["name"], fields["changes"],
+                fields["new"])
+
+# The fields the diff engine compares, in the order changes are reported
+DIFF_FIELDS = ["name", "due_date", "feedback_date", "grade", "feedback"]
+FIELD_LABELS = { "name" : "Name", "due_date" : "Due date",
+        "feedback_date" : "Feedback date", "grade" : "Grade" }
+
+# Compares two PersistentCourseworks field by field. old is None for an
+# assignment we've not seen before.
+def diff_coursework(old, new):
+    changes = []
+    for field in DIFF_FIELDS:
+        old_value = None
+        if old != None:
+            old_value = getattr(old, field)
+        new_value = getattr(new, field)
+        if old_value == new_value:
+            continue
+        if field == "feedback":
+            old_entries = old_value or []
+            for entry in old_entries:
+                if entry not in new_value:
+                    changes.append([field, _format_field(field, entry), None])
+            for entry in new_value:
+                if entry not in old_entries:
+                    changes.append([field, None, _format_field(field, entry)])
+        else:
+            changes.append([field, _format_field(field, old_value),
+                _format_field(field, new_value)])
+    return CourseworkDiff(new.id, _format_field("name", new.name), changes,
+            old == None)
+
+def _format_field(field, value):
+    if value == None:
+        return None
+    if field == "due_date":
+        return unicode(time.strftime("%d %b %y, %H:%M", value))
+    elif field == "feedback_date":
+        return unicode(time.strftime("%d %b %y", value))
+    elif field == "grade":
+        return u"%g" % value
+    elif isinstance(value, str): # Names and feedback may be UTF-8 strs
+        return value.decode("utf-8", "replace")
+    return value
+
+# Combines a diff from an earlier run with one from a later run, as if the
+# two runs had been one: each field goes from its earliest old value to its
+# latest new one, and fields which went back to where they started drop out.
+# Likewise feedback added in one run and removed in the other (or the other
+# way around) cancels out.
+def merge_diff(earlier, later):
+    changes = []
+    latest = {}
+    for change in earlier.changes + later.changes:
+        (field, old, new) = change
+        if field == "feedback":
+            if [field, new, old] in changes:
+                changes.remove([field, new, old])
+            elif list(change) not in changes:
+                changes.append(list(change))
+        elif field in latest:
+            latest[field][2] = new
+        else:
+            latest[field] = list(change)
+            changes.append(latest[field])
+    changes = [change for change in changes if change[1] != change[2]]
+    return CourseworkDiff(later.id, later.name, changes, earlier.new)
+
+# Merges two sets of diffs, as returned by spider. Assignments whose changes
+# all cancel out are left out, along with any tools and modules left empty.
+def merge_diffs(earlier, later):
+    ret = {}
+    for diffs in (earlier, later):
+        for (module_code, module_diffs) in diffs.iteritems():
+            ret_module = ret.setdefault(module_code, {})
+            for (cwk_toolname, cwk_diffs) in module_diffs.iteritems():
+                ret_tool = ret_module.setdefault(cwk_toolname, [])
+                for cwk_diff in cwk_diffs:
+                    for (i, existing) in enumerate(ret_tool):
+                        if existing.id == cwk_diff.id:
+                            ret_tool[i] = merge_diff(existing, cwk_diff)
+                            break
+                    else:
+                        ret_tool.append(cwk_diff)
+    for (module_code, module_diffs) in ret.items():
+        for (cwk_toolname, cwk_diffs) in module_diffs.items():
+            cwk_diffs = [cwk_diff for cwk_diff in cwk_diffs \
+                    if cwk_diff.new or len(cwk_diff.changes) > 0]
+            if len(cwk_diffs) > 0:
+                module_diffs[cwk_toolname] = cwk_diffs
+            else:
+                del module_diffs[cwk_toolname]
+        if len(module_diffs) == 0:
+            del ret[module_code]
+    return ret
+
+def dump_diffs(diffs):
+    return json.dumps(dict((module_code, dict((cwk_toolname,
+        [cwk_diff.to_dict() for cwk_diff in cwk_diffs]) for \
+        (cwk_toolname, cwk_diffs) in module_diffs.iteritems())) for \
+        (module_code, module_diffs) in diffs.iteritems()))
+
+def load_diffs(diffs_str):
+    if diffs_str == None:
+        return {}
+    return dict((module_code, dict((cwk_toolname,
+        map(CourseworkDiff.from_dict, cwk_diffs)) for \
+        (cwk_toolname, cwk_diffs) in module_diffs.iteritems())) for \
+        (module_code, module_diffs) in json.loads(diffs_str).iteritems())
+
+# Stores hold the last seen version of each coursework tool's assignments,
+# along with the fingerprint of the tool's page. Changes for a run are
+# written with update_tool, and only made permanent by commit.
+#
+# ShelveStore is the original store: a shelf mapping each tool's key to a
+# dict of its PersistentCourseworks (by str(id)), plus key + ":fingerprint".
+class ShelveStore(object):
+    def __init__(self, filename):
+        self.shelf = shelve.open(filename)
+
+    # Returns a dict of the tool's PersistentCourseworks, or None if we've
+    # not seen the tool before.
+    def get_assignments(self, key):
+        return self.shelf.get(key)
+
+    def get_fingerprint(self, key):
+        return self.shelf.get(get_fingerprint_key(key))
+
+    # changed is a dict of the new and changed PersistentCourseworks
+    def update_tool(self, cwk_tool, key, changed, fingerprint):
+        assignment_dict = self.shelf.get(key, {})
+        assignment_dict.update(changed)
+        self.shelf[key] = assignment_dict
+        self.shelf[get_fingerprint_key(key)] = fingerprint
+
+    # Small bits of per-account state, such as the digest waiting to go out.
+    # Values are strs, or None to remove them.
+    def get_state(self, name):
+        return self.shelf.get(get_state_key(name))
+
+    def set_state(self, name, value):
+        if value == None:
+            self.shelf.pop(get_state_key(name), None)
+        else:
+            self.shelf[get_state_key(name)] = value
+
+    def commit(self):
+        self.shelf.sync()
+
+    def close(self):
+        self.shelf.close()
+
+# SQLiteStore keeps one row per tool, assignment and feedback entry, so that
+# a run only writes what's changed, and the data can be queried across tools.
+# All of a run's updates happen in a single transaction.
+class SQLiteStore(object):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tools (
+            key TEXT PRIMARY KEY,
+            url TEXT,
+            name TEXT,
+            fingerprint TEXT
+        );
+        CREATE TABLE IF NOT EXISTS assignments (
+            tool_key TEXT NOT NULL REFERENCES tools (key),
+            assignment_id INTEGER NOT NULL,
+            name TEXT,
+            due_date TEXT,
+            feedback_date TEXT,
+            grade REAL,
+            PRIMARY KEY (tool_key, assignment_id)
+        );
+        CREATE INDEX IF NOT EXISTS assignments_by_id
+            ON assignments (assignment_id);
+        CREATE TABLE IF NOT EXISTS feedback (
+            tool_key TEXT NOT NULL,
+            assignment_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            content TEXT,
+            PRIMARY KEY (tool_key, assignment_id, position)
+        );
+        CREATE TABLE IF NOT EXISTS state (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        # Feedback is stored as UTF-8 encoded strs, so get strs back out
+        self.conn.text_factory = str
+        self.conn.executescript(SQLiteStore.SCHEMA)
+
+    def get_assignments(self, key):
+        if self.conn.execute("SELECT 1 FROM tools WHERE key = ?",
+                (key,)).fetchone() == None:
+            return None
+        feedback = {}
+        for (assignment_id, content) in self.conn.execute(
+                "SELECT assignment_id, content FROM feedback WHERE tool_key = ? "
+                "ORDER BY assignment_id, position", (key,)):
+            feedback.setdefault(assignment_id, []).append(content)
+
+        assignment_dict = {}
+        for (assignment_id, name, due_date, feedback_date, grade) in \
+                self.conn.execute("SELECT assignment_id, name, due_date, "
+                "feedback_date, grade FROM assignments WHERE tool_key = ?", (key,)):
+            assignment_dict[str(assignment_id)] = PersistentCoursework(
+                    assignment_id, name.decode("utf-8"), _load_time(due_date),
+                    _load_time(feedback_date), feedback.get(assignment_id, []),
+                    grade)
+        return assignment_dict
+
+    def get_fingerprint(self, key):
+        row = self.conn.execute("SELECT fingerprint FROM tools WHERE key = ?",
+                (key,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def update_tool(self, cwk_tool, key, changed, fingerprint):
+        self._update_tool(key, cwk_tool.url, cwk_tool.name, changed, fingerprint)
+
+    def _update_tool(self, key, url, name, changed, fingerprint):
+        self.conn.execute("INSERT OR REPLACE INTO tools (key, url, name, "
+                "fingerprint) VALUES (?, ?, ?, ?)", (key, url, name, fingerprint))
+        for persistent_assignment in changed.itervalues():
+            assignment_id = persistent_assignment.id
+            self.conn.execute("INSERT OR REPLACE INTO assignments (tool_key, "
+                    "assignment_id, name, due_date, feedback_date, grade) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (key, assignment_id,
+                    persistent_assignment.name,
+                    _dump_time(persistent_assignment.due_date),
+                    _dump_time(persistent_assignment.feedback_date),
+                    persistent_assignment.grade))
+            self.conn.execute("DELETE FROM feedback WHERE tool_key = ? AND "
+                    "assignment_id = ?", (key, assignment_id))
+            self.conn.executemany("INSERT INTO feedback (tool_key, "
+                    "assignment_id, position, content) VALUES (?, ?, ?, ?)",
+                    [(key, assignment_id, position, content) for \
+                    (position, content) in enumerate(persistent_assignment.feedback)])
+
+    def get_state(self, name):
+        row = self.conn.execute("SELECT value FROM state WHERE name = ?",
+                (name,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def set_state(self, name, value):
+        if value == None:
+            self.conn.execute("DELETE FROM state WHERE name = ?", (name,))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO state (name, value) "
+                    "VALUES (?, ?)", (name, value))
+
+    # Copies everything from an old shelve store. The shelf doesn't record
+    # tool URLs or names, so those are left empty until the tool next changes.
+    def migrate_from_shelve(self, filename):
+        shelf = shelve.open(filename, "r")
+        try:
+            for key in shelf.keys():
+                if key.startswith(STATE_PREFIX):
+                    self.set_state(key[len(STATE_PREFIX):], shelf[key])
+                    continue
+                if key.endswith(":fingerprint"):
+                    continue
+                self._update_tool(key, None, None, shelf[key],
+                        shelf.get(get_fingerprint_key(key)))
+        finally:
+            shelf.close()
+        self.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# Dates are time.struct_times, which round trip exactly through JSON lists
+def _dump_time(struct_time):
+    if struct_time == None:
+        return None
+    return json.dumps(list(struct_time))
+
+def _load_time(time_str):
+    if time_str == None:
+        return None
+    return time.struct_time(json.loads(time_str))
+
+# Opens the store of the given type ("shelve" or "sqlite"). The first time the
+# SQLite store is opened, anything in an existing shelve store is copied over.
+# prefix goes in front of the file names, to keep accounts apart.
+def open_store(store_type, prefix=""):
+    if store_type == "shelve":
+        return ShelveStore(prefix + STORE_NAME)
+    elif store_type == "sqlite":
+        is_new = not os.path.exists(prefix + SQLITE_STORE_NAME)
+        store = SQLiteStore(prefix + SQLITE_STORE_NAME)
+        if is_new and whichdb.whichdb(prefix + STORE_NAME):
+            store.migrate_from_shelve(prefix + STORE_NAME)
+        return store
+    raise ImproperUseError("Unknown store type %s" % store_type)
+
+# The settings for one MMS account, from a section of the config file, and
+# the account's MMSLib while a run or poll is going on. The lib is closed at
+# the end of each one, so that its cache index is saved and its worker pools
+# stopped; set cookie_file to keep the session from one poll to the next.
+class Account(object):
+    def __init__(self, name, user, password, email, options, store_type,
+            interval, digest_interval=0):
+        self.name = name
+        self.user = user
+        self.password = password
+        self.email = email
+        self.options = options
+        self.store_type = store_type
+        self.interval = interval
+        self.digest_interval = digest_interval
+        self.store_prefix = ""
+        self.lib = None
+
+    def get_lib(self):
+        if self.lib == None:
+            self.lib = MMSLib(self.user, self.password, **self.options)
+        return self.lib
+
+    def close_lib(self):
+        if self.lib != None:
+            self.lib.close()
+            self.lib = None
+
+def parse_account(config, section, name):
+    user = config.get(section, "user")
+    password = config.get(section, "password")
+    email = config.get(section, "email")
+    # Optional settings, passed straight through to MMSLib.
+    options = {}
+    if config.has_option(section, "workers"):
+        options["max_workers"] = config.getint(section, "workers")
+    if config.has_option(section, "cache_dir"):
+        options["cache_dir"] = config.get(section, "cache_dir")
+    if config.has_option(section, "cookie_file"):
+        options["cookie_file"] = config.get(section, "cookie_file")
+    transport = MMSTransportPolicy()
+    if config.has_option(section, "timeout"):
+        transport.timeout = config.getfloat(section, "timeout")
+    if config.has_option(section, "retries"):
+        transport.retries = config.getint(section, "retries")
+    options["transport"] = transport
+    store_type = "shelve"
+    if config.has_option(section, "store"):
+        store_type = config.get(section, "store")
+    interval = DEFAULT_INTERVAL
+    if config.has_option(section, "interval"):
+        interval = config.getint(section, "interval")
+    digest_interval = 0
+    if config.has_option(section, "digest_interval"):
+        digest_interval = config.getint(section, "digest_interval")
+    return Account(name, user, password, email, options, store_type, interval,
+            digest_interval)
+
 def parse_config():
     config = ConfigParser.RawConfigParser()
     config.read(CONF_FILE)
-    user = config.get("mmspider", "user")
-    password = config.get("mmspider", "password")
-    email = config.get("mmspider", "email")
-    return (user, password, email)
+    return parse_account(config, "mmspider", "mmspider")
+
+# Daemon mode reads every [account NAME] section, along with the shared
+# settings in [daemon]. Each account gets its own store, prefixed NAME-.
+def parse_daemon_config():
+    config = ConfigParser.RawConfigParser()
+    config.read(CONF_FILE)
+    accounts = []
+    for section in config.sections():
+        if section.startswith("account "):
+            name = section[len("account "):].strip()
+            account = parse_account(config, section, name)
+            account.store_prefix = name + "-"
+            accounts.append(account)
+
+    settings = { "workers" : DEFAULT_DAEMON_WORKERS,
+            "jitter" : DEFAULT_JITTER, "smtp_host" : "localhost" }
+    if config.has_section("daemon"):
+        if config.has_option("daemon", "workers"):
+            settings["workers"] = config.getint("daemon", "workers")
+        if config.has_option("daemon", "jitter"):
+            settings["jitter"] = config.getint("daemon", "jitter")
+        if config.has_option("daemon", "smtp_host"):
+            settings["smtp_host"] = config.get("daemon", "smtp_host")
+    return (accounts, settings)
 
 # SHA256 hash of cwk tool URL
 def get_persistent_key(cwk_tool):
@@ -53,110 +474,306 @@ def get_persistent_key(cwk_tool):
     m.update(cwk_tool.url)
     return m.hexdigest()
 
+# The fingerprint of a tool's page is stored alongside its assignments
+def get_fingerprint_key(key):
+    return key + ":fingerprint"
+
+# Shelve keys for ShelveStore.get_state
+STATE_PREFIX = "state:"
+
+def get_state_key(name):
+    return STATE_PREFIX + name
+
+def get_fingerprint(cwk_page):
+    return hashlib.sha256(cwk_page).hexdigest()
+
 # Populates the store for a given tool
-def populate_store(persistent_assignments, store, key):
+def populate_store(persistent_assignments, store, cwk_tool, key, fingerprint):
     assignment_dict = {}
     for persistent_assignment in persistent_assignments:
         # Create a persistent assignment instance, and store it
         assignment_dict[str(persistent_assignment.id)] = persistent_assignment
-    store[key] = assignment_dict
+    store.update_tool(cwk_tool, key, assignment_dict, fingerprint)
+
+
+# Fetches the assignments for a tool along with their persistent versions.
+# This is where all the requests happen, and it doesn't touch the store, so
+# it's safe to run for several tools at once.
+# If the page hasn't changed since last time (it has the same fingerprint),
+# there's nothing more to do, so the assignments come back as None. Otherwise
+# all the feedback for the tool is fetched in one go.
+def fetch_cwk(cwk_tool, old_fingerprint=None):
+    cwk_page = cwk_tool.get_page()
+    fingerprint = get_fingerprint(cwk_page)
+    if fingerprint == old_fingerprint:
+        return (fingerprint, None, None)
 
+    assignments = cwk_tool.parse_assignments(cwk_page)
+    all_feedback = cwk_tool.get_all_feedback(assignments)
+    persistent_assignments = []
+    for (assignment, feedback) in zip(assignments, all_feedback):
+        # Storing an error would look like a change next time round
+        for entry in feedback:
+            if isinstance(entry, FetchError):
+                raise entry.error
+        persistent_assignments.append(
+                PersistentCoursework.create_from_assignment(assignment, feedback))
+    return (fingerprint, assignments, persistent_assignments)
 
-def check_cwk(lib, cwk_tool, store):
+def check_cwk(lib, cwk_tool, store, fetched=None):
     # Firstly, check whether we have a copy of the coursework stored persistently
     # for this tool. Since we can have multiple cwk tools per module, it's best
     # to actually just index it by a hash of the tool URL.
     key = get_persistent_key(cwk_tool)
-    assignments = cwk_tool.get_assignments()
-    persistent_assignments = \
-        [PersistentCoursework.create_from_assignment(x) for x in assignments]
+    if fetched == None:
+        fetched = fetch_cwk(cwk_tool, store.get_fingerprint(key))
+    (fingerprint, assignments, persistent_assignments) = fetched
+    if assignments == None: # Page hasn't changed, so neither has anything else
+        return []
 
     # If it's not in there, populate it, and don't notify the user.
-    if key not in store:
-        populate_store(persistent_assignments, store, key)
+    assignment_dict = store.get_assignments(key)
+    if assignment_dict == None:
+        populate_store(persistent_assignments, store, cwk_tool, key, fingerprint)
         return [] # Don't return anything, so the user's not notified on first run
 
     # If it is, we can get a list of diffs, and email them.
     diffs = []
-    assignment_dict = store[key]
-    for assignment in assignments:
-        persistent_assignment = \
-                PersistentCoursework.create_from_assignment(assignment)
-        assignment_key = str(assignment.id)
-        if assignment_key in assignment_dict:
-            # Check whether they're the same, if not, add to diffs.
-            if persistent_assignment != assignment_dict[assignment_key]:
-                assignment_dict[assignment_key] = persistent_assignment
-                diffs.append(assignment)
-        else: # If the cwk isn't in there, add it. Also add to diffs.
-            assignment_dict[assignment_key] = persistent_assignment
-            diffs.append(assignment)
-    # Finally, persist the updated assignment store and return diffs
-    store[key] = assignment_dict
+    changed = {}
+    for persistent_assignment in persistent_assignments:
+        assignment_key = str(persistent_assignment.id)
+        # If the cwk isn't in there, it's all new
+        old = assignment_dict.get(assignment_key)
+        if persistent_assignment != old:
+            changed[assignment_key] = persistent_assignment
+            diffs.append(diff_coursework(old, persistent_assignment))
+    # Finally, persist the changed assignments and return diffs
+    store.update_tool(cwk_tool, key, changed, fingerprint)
     return diffs
 
-# Given an assignment, generates the string representation
-# to put in the email
+# Given a CourseworkDiff, generates the lines to put in the email. Everything
+# needed is in the diff, so nothing has to be fetched again.
+def generate_cwk_lines(diff):
+    if diff.new:
+        lines = [u"New assignment: %s" % diff.name]
+    else:
+        lines = [u"Assignment %s:" % diff.name]
+    for (field, old, new) in diff.changes:
+        if field == "feedback":
+            if new != None:
+                lines.append(u"New feedback: %s" % new)
+            else:
+                lines.append(u"Feedback removed: %s" % old)
+        elif old == None:
+            lines.append(u"%s: %s" % (FIELD_LABELS[field], new))
+        else:
+            lines.append(u"%s changed: %s -> %s" % (FIELD_LABELS[field], old,
+                new if new != None else "none"))
+    return lines
+
 def generate_cwk_str(diff):
-    ret = str(diff) + "\r\n"
-    feedback = diff.get_feedback()
-    for feedback_entry in feedback:
-        ret = ret + str(feedback_entry) + "\r\n"
-    return ret
+    return u"\r\n".join(generate_cwk_lines(diff)) + u"\r\n"
 
+# The body of the email, as a UTF-8 str
 def generate_msg_body(diffs):
-    ret = MSG_TEXT + "\r\n"
-    for module_code, module_diffs in diffs.iteritems():
-        ret = ret + "Module " + module_code + ":\r\n"
-        for cwk_toolname, cwk_diffs in module_diffs.iteritems():
-            ret = ret + "Coursework tool name: " + cwk_toolname + "\r\n"
+    lines = [MSG_TEXT]
+    for module_code, module_diffs in sorted(diffs.iteritems()):
+        lines.append(u"Module %s:" % module_code)
+        for cwk_toolname, cwk_diffs in sorted(module_diffs.iteritems()):
+            lines.append(u"Coursework tool name: %s" % cwk_toolname)
             for cwk_diff in cwk_diffs:
-                ret = ret + generate_cwk_str(cwk_diff) + "\r\n"
-    return ret
+                lines.extend(generate_cwk_lines(cwk_diff))
+                lines.append(u"")
+    return u"\r\n".join(lines).encode("utf-8") + "\r\n"
+
+# Changes can be saved up and sent as one digest, at most once every
+# digest_interval seconds. Adds diffs to whatever's waiting in the store, and
+# returns everything that should be sent now (which may be nothing).
+def take_digest(store, diffs, digest_interval):
+    pending = merge_diffs(load_diffs(store.get_state("pending_digest")), diffs)
+    if len(pending) == 0:
+        # Whatever was pending may have cancelled out
+        store.set_state("pending_digest", None)
+        return {}
+    now = time.time()
+    last_sent = store.get_state("digest_sent")
+    if digest_interval > 0 and last_sent != None and \
+            now - float(last_sent) < digest_interval:
+        store.set_state("pending_digest", dump_diffs(pending))
+        return {}
+    store.set_state("pending_digest", None)
+    store.set_state("digest_sent", repr(now))
+    return pending
+
+# Sends mail over one SMTP connection, which is kept open between messages
+# and reopened if the server has hung up in the meantime.
+class Mailer(object):
+    def __init__(self, host="localhost"):
+        self.host = host
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        with self._lock:
+            try:
+                self._connect().sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                self._conn = None
+                self._connect().sendmail(from_addr, to_addrs, msg)
 
-def email_diffs(diffs, email_address):
+    def _connect(self):
+        if self._conn == None:
+            self._conn = smtplib.SMTP(self.host)
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn != None:
+                try:
+                    self._conn.quit()
+                except smtplib.SMTPException:
+                    pass
+                self._conn = None
+
+def email_diffs(diffs, email_address, mailer=None):
     msg_body = generate_msg_body(diffs)
-    msg = ("From: %s\r\nTo: %s\r\nSubject: %s\r\n\r\n" % (email_address, \
-            email_address, SUBJECT_LINE)) + msg_body
+    msg = ("From: %s\r\nTo: %s\r\nSubject: %s\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n\r\n" % \
+            (email_address, email_address, SUBJECT_LINE)) + msg_body
+    if mailer != None:
+        mailer.sendmail(email_address, [email_address], msg)
+        return
     s = smtplib.SMTP('localhost')
     s.sendmail(email_address, [email_address], msg)
     s.quit()
 
 def main():
+    if "--daemon" in sys.argv:
+        daemon_main()
+        return
+
     # Firstly, parse the config file
     if not os.path.exists(CONF_FILE):
         print "Error: mmspider.conf does not exist!"
         sys.exit(-1)
-    (user, passwd, email) = parse_config()
+    account = parse_config()
 
     # Secondly, create a library instance, and get all the coursework tools
     try:
-        lib = MMSLib(user, passwd)
+        lib = account.get_lib()
     except AuthenticationError:
         print "Error: Incorrect username or password."
         sys.exit(-1)
 
-    store = shelve.open(STORE_NAME)
+    store = open_store(account.store_type)
+    try:
+        diffs = take_digest(store, spider(lib, store), account.digest_interval)
+        store.commit()
+    finally:
+        store.close()
+        account.close_lib()
+    # Email the diffs if we need to, and we're done!
+    if len(diffs) > 0:
+        email_diffs(diffs, account.email)
+        print "Email sent!"
+    else:
+        print "No changes!"
+
+# Checks all of the coursework tools for the current year, updating the store,
+# and returns the changes as { module code : { tool name : [CourseworkDiff] } }.
+def spider(lib, store):
     modules = lib.get_modules()
+
+    # Fetch every coursework tool up front, concurrently. The store is only
+    # updated afterwards, in module and tool order, so the results are the
+    # same whatever order the requests happened to finish in.
+    all_tools = [cwk_tool for module in modules \
+            for cwk_tool in module.get_tools(MMSToolType.Coursework)]
+    keys = map(get_persistent_key, all_tools)
+    old_fingerprints = [store.get_fingerprint(key) for key in keys]
+    fetched = dict(zip(keys, lib.map_concurrent(lambda (tool, fingerprint): \
+            fetch_cwk(tool, fingerprint), zip(all_tools, old_fingerprints))))
+
     diffs = {}
     for module in modules:
         cwk_tools = module.get_tools(MMSToolType.Coursework)
         module_diffs = {}
         for cwk_tool in cwk_tools:
-            cwk_diffs = check_cwk(lib, cwk_tool, store)
+            cwk_diffs = check_cwk(lib, cwk_tool, store, \
+                    fetched[get_persistent_key(cwk_tool)])
             if (len(cwk_diffs) > 0):
                 module_diffs[cwk_tool.name] = cwk_diffs
 
         if (len(module_diffs) > 0):
             diffs[module.module_code] = module_diffs
+    return diffs
 
-    store.close()
-    # Email the diffs if we need to, and we're done!
-    if len(diffs) > 0:
-        email_diffs(diffs, email)
-        print "Email sent!"
-    else:
-        print "No changes!"
+# Polls one account: spiders it and mails out any changes.
+def poll_account(account, mailer):
+    try:
+        lib = account.get_lib()
+        store = open_store(account.store_type, account.store_prefix)
+        try:
+            diffs = take_digest(store, spider(lib, store),
+                    account.digest_interval)
+            store.commit()
+        finally:
+            store.close()
+        if len(diffs) > 0:
+            email_diffs(diffs, account.email, mailer)
+            print "%s: Email sent!" % account.name
+    except AuthenticationError:
+        print "%s: Error: Incorrect username or password." % account.name
+    except Exception:
+        print "%s: Error while polling:" % account.name
+        traceback.print_exc()
+    finally:
+        account.close_lib()
+
+# Polls every account forever. Each account is polled every interval seconds
+# (plus up to jitter seconds, so they don't all line up), on a pool shared
+# between all the accounts. An account isn't polled again until its last poll
+# has finished.
+def run_daemon(accounts, settings):
+    pool = ThreadPool(settings["workers"])
+    mailer = Mailer(settings["smtp_host"])
+    schedule_changed = threading.Condition()
+    schedule = []
+
+    def schedule_poll(account, delay):
+        when = time.time() + delay + random.uniform(0, settings["jitter"])
+        with schedule_changed:
+            heapq.heappush(schedule, (when, id(account), account))
+            schedule_changed.notify()
+
+    for account in accounts:
+        schedule_poll(account, 0)
+    try:
+        while True:
+            with schedule_changed:
+                # Nothing's due if everything is being polled right now
+                while len(schedule) == 0 or schedule[0][0] > time.time():
+                    if len(schedule) == 0:
+                        schedule_changed.wait(DEFAULT_INTERVAL)
+                    else:
+                        schedule_changed.wait(schedule[0][0] - time.time())
+                (when, _, account) = heapq.heappop(schedule)
+            pool.apply_async(poll_account, (account, mailer),
+                    callback=lambda _, account=account: \
+                            schedule_poll(account, account.interval))
+    finally:
+        pool.terminate()
+        mailer.close()
+
+def daemon_main():
+    if not os.path.exists(CONF_FILE):
+        print "Error: mmspider.conf does not exist!"
+        sys.exit(-1)
+    (accounts, settings) = parse_daemon_config()
+    if len(accounts) == 0:
+        print "Error: no [account NAME] sections in mmspider.conf!"
+        sys.exit(-1)
+    run_daemon(accounts, settings)
 
 # Checks to see whether any coursework has been updated.
 